@@ -0,0 +1,237 @@
+""" Benchmarks of the distribution and statistics paths on a synthetic holters tree.
+
+Usage: python bench.py --doctors 20 --days 60 --files 10 --batch 300 --output bench.json
+
+The tree (<output>/<doctor>/<dd.mm.YYYY>/<holter>.ZHR with windows-1251 headers)
+and its config are created in a temporary folder, real config.yaml is not touched.
+
+Startup of the web worker (import web and the first request in a new interpreter,
+with the index already built) is checked against --startup-budget-ms, the script
+exits with code 1 when it is over the budget.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+import config
+
+FIRST_NAMES = ["Іван", "Олена", "Петро", "Марія", "Тарас", "Оксана", "Андрій", "Ірина"]
+LAST_NAMES = ["Петренко", "Коваленко", "Шевченко", "Бондаренко", "Ткаченко", "Мельник", "Лисенко"]
+STATIONS = ["AB", "AC", "AD", "AE", "AF"]
+
+
+def _make_holter(path: str, body_size: int):
+    name = random.choice(LAST_NAMES) + random.choice(FIRST_NAMES) + random.choice(FIRST_NAMES) + "ович"
+    birth_date = datetime.date(random.randint(1940, 2005), random.randint(1, 12), random.randint(1, 28))
+    header = (
+        b"\x00\x01ZHR\x00" * 16 + b"\r\n"
+        + f"{name}\r\n".encode("windows-1251")
+        + f"{birth_date.strftime('%d.%m.%Y')} Регистратор Philips DigiTrak XT\r\n".encode("windows-1251")
+    )
+    with open(path, "wb") as f:
+        f.write(header + os.urandom(body_size))
+
+
+def _make_holter_name():
+    return random.choice(STATIONS) + "".join(random.choices(string.ascii_uppercase + string.digits, k=8)) + ".ZHR"
+
+
+def create_tree(root: str, doctors: int, days: int, files: int, body_size: int, batch: int):
+    """ Create input, output and rejected folders with the config in the root, passes move up to batch holters. """
+    for folder in ("input", "output", "rejected"):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    today = datetime.date.today()
+    doctors_config = []
+    for doctor_number in range(doctors):
+        folder_name = f"D{doctor_number:03d}"
+        doctors_config.append({"name": f"Doctor {doctor_number}", "folder_name": folder_name, "limit": -1})
+        for day in range(days):
+            date_path = os.path.join(
+                root, "output", folder_name, (today - datetime.timedelta(days=day)).strftime("%d.%m.%Y")
+            )
+            os.makedirs(date_path)
+            for _ in range(files):
+                _make_holter(os.path.join(date_path, _make_holter_name()), body_size)
+    bench_config = {
+        "input_path": os.path.join(root, "input"),
+        "output_path": os.path.join(root, "output"),
+        "rejected_path": os.path.join(root, "rejected"),
+        "evening_hours": 0,
+        "index_path": os.path.join(root, "holters.sqlite3"),
+        "stable_seconds": 0,
+        "max_batch": batch,
+        "doctors": doctors_config,
+        "users": [{"username": "bench", "password": "bench", "is_admin": True}],
+    }
+    with open(os.path.join(root, "config.yaml"), "w", encoding="utf-8") as f:
+        json.dump(bench_config, f, ensure_ascii=False)  # JSON is valid YAML
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+
+def _summarize(durations, items=1):
+    total = sum(durations)
+    return {
+        "runs": len(durations),
+        "p50_ms": round(_percentile(durations, 50) * 1000, 3),
+        "p95_ms": round(_percentile(durations, 95) * 1000, 3),
+        "items_per_second": round(items * len(durations) / total, 2) if total else None,
+    }
+
+
+def _timed(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_distribution(batch: int, repeat: int, body_size: int):
+    import move_holters
+    input_path = config.get()["input_path"]
+    durations = []
+    for _ in range(repeat):
+        for _ in range(batch):
+            _make_holter(os.path.join(input_path, _make_holter_name()), body_size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = move_holters.distribute_holters()
+            durations.append(time.perf_counter() - start)
+        assert not result.backlog and not os.listdir(input_path), "holters were left in the input folder"
+    return _summarize(durations, items=batch)
+
+
+def bench_patient_data(repeat: int):
+    import holter
+    output_path = config.get()["output_path"]
+    doctor = sorted(os.listdir(output_path))[0]
+    date_folder = sorted(os.listdir(os.path.join(output_path, doctor)))[0]
+    paths = holter.get_in_folder(os.path.join(output_path, doctor, date_folder))
+    return {
+        "read_header": _summarize(_timed(lambda: [holter.read_header(path) for path in paths], repeat), len(paths)),
+        "get_patient_data": _summarize(
+            _timed(lambda: [holter.get_patient_data(path) for path in paths], repeat), len(paths)
+        ),
+        "get_patients_data": _summarize(_timed(lambda: holter.get_patients_data(paths), repeat), len(paths)),
+    }
+
+
+def bench_pages(repeat: int):
+    import web
+    client = web.app.test_client()
+    client.post("/login", data={"username": "bench", "password": "bench"})
+    today = datetime.date.today()
+    doctor = sorted(os.listdir(config.get()["output_path"]))[0]
+    urls = {
+        "monthly_stats": f"/{today.year}/{today.month}/",
+        "yearly_stats": f"/{today.year}/",
+        "daily_stats": f"/{today.year}/{today.month}/{today.day}/",
+        "daily_doctor_stats": f"/{today.year}/{today.month}/{today.day}/{doctor}/",
+    }
+    results = {}
+    for name, url in urls.items():
+        def render():
+            response = client.get(url)
+            assert response.status_code == 200, f"{url} returned {response.status_code}"
+        results[name] = {
+            "first_ms": round(_timed(render, 1)[0] * 1000, 3),
+            **_summarize(_timed(render, repeat)),
+        }
+    return results
+
+
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import web
+imported = time.perf_counter()
+response = web.app.test_client().get("/ready")
+assert response.status_code == 200, response.data
+ready = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "first_request_ms": (ready - imported) * 1000}))
+"""
+
+
+def bench_startup(budget_ms: float, repeat: int):
+    """ Time import of web and its first request, each run in a new interpreter. """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT], env=env, capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    totals = [run["import_ms"] + run["first_request_ms"] for run in runs]
+    return {
+        "import_ms": round(_percentile([run["import_ms"] for run in runs], 50), 3),
+        "first_request_ms": round(_percentile([run["first_request_ms"] for run in runs], 50), 3),
+        "total_ms": round(_percentile(totals, 50), 3),
+        "budget_ms": budget_ms,
+        "within_budget": _percentile(totals, 50) <= budget_ms,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--doctors", type=int, default=20)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--files", type=int, default=10, help="holters per doctor per day")
+    parser.add_argument("--batch", type=int, default=300, help="holters in the input folder per distribution pass")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--body-size", type=int, default=16 * 1024, help="bytes after the header of every holter")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-budget-ms", type=float, default=1000, help="budget of import web + first request")
+    parser.add_argument("--output", help="JSON file for the results, printed to stdout if not given")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory(prefix="telecardio-bench-") as root:
+        create_start = time.perf_counter()
+        create_tree(root, args.doctors, args.days, args.files, args.body_size, args.batch)
+        os.chdir(root)
+        try:
+            results = {
+                "parameters": vars(args),
+                "python": sys.version.split()[0],
+                "tree_creation_s": round(time.perf_counter() - create_start, 3),
+                # pages go first, so their first render includes building the index
+                "pages": bench_pages(args.repeat),
+                "startup": bench_startup(args.startup_budget_ms, max(1, args.repeat // 4)),
+                "patient_data": bench_patient_data(args.repeat),
+                "distribution": bench_distribution(args.batch, max(1, args.repeat // 4), args.body_size),
+            }
+        finally:
+            # Background header parsing writes to the patients cache in the temporary folder
+            import holter
+            holter.stop_prefetch()
+            os.chdir(os.path.dirname(root))
+
+    report = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(report + "\n")
+    print(report)
+    if not results["startup"]["within_budget"]:
+        print(f"Startup took {results['startup']['total_ms']} ms, over the budget of {args.startup_budget_ms} ms.",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
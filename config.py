@@ -1,16 +1,161 @@
+import dataclasses
+import hashlib
+import os
+import tempfile
+import threading
+import typing
 
-import yaml
+import locks
+
+CONFIG_PATH = "config.yaml"
 
 _config = None
+# (mtime, size) of config file when it was loaded, file is re-parsed only when it changes
+_config_stat = None
+# Hash of the loaded file, writers check that the file was not changed since the form was opened
+_revision = None
+_version = 0
+_compiled = {}
+_lock = threading.RLock()
+# Held while the file is re-parsed, readers meanwhile get the previous config instead of waiting
+_load_lock = threading.Lock()
+
+
+class ConflictError(Exception):
+    """ Config file was changed by someone else since it was read. """
+
+
+@dataclasses.dataclass
+class User:
+    username: str
+    password: str
+    is_admin: bool = False
+
+
+def _parse(data: bytes) -> dict:
+    # Imported here, so modules importing config do not pay for YAML until it is read
+    import yaml
+    parsed = yaml.safe_load(data)
+    if not isinstance(parsed, dict):
+        raise ValueError(f"{CONFIG_PATH} must contain a mapping of settings")
+    return parsed
+
+
+def _set(parsed: dict, config_stat, revision: str):
+    global _config, _config_stat, _revision, _version
+    with _lock:
+        _config, _config_stat, _revision = parsed, config_stat, revision
+        _version += 1
+
 
 def get():
-    global _config
-    if _config is None:
-        with open("config.yaml", 'r') as file:
-            _config = yaml.safe_load(file)
+    """ Return the config, re-loaded when the file changes.
+
+    If the file cannot be read or parsed, the last good config is returned, so
+    a broken edit does not stop the distribution and the pages.
+    """
+    global _config_stat
+    try:
+        stat = os.stat(CONFIG_PATH)
+    except OSError:
+        if _config is None:
+            raise
+        return _config
+    config_stat = (stat.st_mtime_ns, stat.st_size)
+    if _config is not None and config_stat == _config_stat:
+        return _config
+    if not _load_lock.acquire(blocking=_config is None):
+        return _config
+    try:
+        if _config is None or config_stat != _config_stat:
+            try:
+                with open(CONFIG_PATH, 'rb') as file:
+                    data = file.read()
+                _set(_parse(data), config_stat, hashlib.sha1(data).hexdigest())
+            except Exception as e:
+                if _config is None:
+                    raise
+                print(f"ERROR! Failed to load {CONFIG_PATH}, keeping the last good config. Error: {e}")
+                # Not re-parsed until the file changes again
+                _config_stat = config_stat
+    finally:
+        _load_lock.release()
     return _config
 
 
+def revision() -> str:
+    """ Return hash of the loaded config file, to be passed back to update as expected_revision. """
+    get()
+    return _revision
+
+
+def update(
+    modify: typing.Callable[[dict], None],
+    format_config: typing.Callable[[dict], str],
+    expected_revision: typing.Optional[str] = None,
+) -> dict:
+    """ Apply modify to the config read from the file and write it with format_config, return the new config.
+
+    Writers take a lock shared by all processes. The file is written to a
+    temporary file and renamed over the config, so readers never see a half
+    written file. ConflictError is raised when the file does not match
+    expected_revision anymore, i.e. someone else saved it in the meantime.
+    """
+    lock = locks.FileLock(CONFIG_PATH + ".lock")
+    if not lock.acquire(timeout=10):
+        raise ConflictError("Config is being saved by someone else, please try again")
+    try:
+        with open(CONFIG_PATH, 'rb') as file:
+            data = file.read()
+        current_revision = hashlib.sha1(data).hexdigest()
+        if expected_revision is not None and expected_revision != current_revision:
+            raise ConflictError("Config was changed by someone else, please review the changes and save again")
+        updated = _parse(data)
+        modify(updated)
+        new_data = format_config(updated).encode("utf-8")
+        # Never write a config which cannot be read back
+        updated = _parse(new_data)
+
+        folder = os.path.dirname(os.path.abspath(CONFIG_PATH))
+        fd, temp_path = tempfile.mkstemp(prefix=".config-", suffix=".yaml", dir=folder)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(new_data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, CONFIG_PATH)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        stat = os.stat(CONFIG_PATH)
+        _set(updated, (stat.st_mtime_ns, stat.st_size), hashlib.sha1(new_data).hexdigest())
+        return updated
+    finally:
+        lock.release()
+
+
+def version() -> int:
+    """ Return number which is increased every time config is re-loaded. """
+    get()
+    return _version
+
+
+def compiled(name: str, factory: typing.Callable[[dict], typing.Any]):
+    """ Return factory(config), factory is called again only when config changes. """
+    with _lock:
+        _config = get()
+        if name not in _compiled or _compiled[name][0] != _version:
+            _compiled[name] = (_version, factory(_config))
+        return _compiled[name][1]
+
+
+def get_users() -> typing.Dict[str, User]:
+    return compiled("users", lambda _config: {
+        user["username"]: User(**user) for user in _config.get("users", [])
+    })
+
+
 def reset():
     global _config
     _config = None
@@ -1,45 +1,132 @@
+import calendar
 import datetime
+import hashlib
 import os
 import typing as t
-import yaml
 import config
+import index
+import locks
+import scan
+
+# Daily counts of finished months, they do not change anymore
+_finished_months_cache = {}
+_finished_months_built_at = None
+# Mtime of the current days' folders when they were last synced with the index
+_folders_mtime = {}
+
 
 def get_daily_metadata(month=None, year=None) -> t.Dict[str, t.Dict[datetime.date, int]]:
     """ Return how many holters each doctor have per day """
+    doctors = _get_doctors()
+    daily_counts = _get_daily_counts(month=month, year=year)
+    return {doctor: daily_counts.get(doctor, {}) for doctor in doctors}
+
+
+def get_daily_matrix(year: int, month: int) -> t.Tuple[t.List[str], t.List[t.List[int]]]:
+    """ Return doctors and their holters count for every day of the month, row per doctor """
+    num_days = calendar.monthrange(year, month)[1]
+    daily_metadata = get_daily_metadata(month=month, year=year)
+    matrix = []
+    for doctor_metadata in daily_metadata.values():
+        row = [0] * num_days
+        for date_, count in doctor_metadata.items():
+            row[date_.day - 1] = count
+        matrix.append(row)
+    return list(daily_metadata), matrix
+
+
+def get_monthly_matrix(year: int) -> t.Tuple[t.List[str], t.List[t.List[int]]]:
+    """ Return doctors and their holters count for every month of the year, row per doctor """
+    doctors = _get_doctors()
+    monthly_counts = index.get_monthly_counts(year)
+    matrix = []
+    for doctor in doctors:
+        row = [0] * 12
+        for month, count in monthly_counts.get(doctor, {}).items():
+            row[month - 1] = count
+        matrix.append(row)
+    return doctors, matrix
+
+
+def _get_doctors() -> t.List[str]:
+    """ Return doctors' folders, syncing the index with their current days' folders """
     doctors = os.listdir(config.get()["output_path"])
-    data = {}
+    sync_current_folders(doctors)
+    return doctors
+
+
+def get_stats_version(year: int, month: int) -> str:
+    """ Return version of the month's stats without scanning the holters: it changes
+    when the index is written, doctor folder is added or the current days' folders change. """
+    output_path = config.get()["output_path"]
+    parts = [str(index.get_version()), str(os.stat(output_path).st_mtime_ns)]
+    current_dates = sorted(date for date in _get_current_dates() if (date.year, date.month) == (year, month))
+    if current_dates:
+        for doctor in sorted(os.listdir(output_path)):
+            for date in current_dates:
+                try:
+                    parts.append(str(os.stat(os.path.join(output_path, doctor, date.strftime("%d.%m.%Y"))).st_mtime_ns))
+                except FileNotFoundError:
+                    parts.append("-")
+    return hashlib.sha1("/".join(parts).encode()).hexdigest()
+
+
+def _get_current_dates() -> t.Set[datetime.date]:
+    """ Return dates which folders still can change: today and, in the evening, tomorrow. """
+    now = datetime.datetime.now()
+    evening_date = (now + datetime.timedelta(hours=config.get().get("evening_hours", 0))).date()
+    return {now.date(), evening_date}
+
+
+def sync_current_folders(doctors: t.Optional[t.List[str]] = None):
+    """ Rescan current days' folders of the doctors (all by default) which were changed since the last sync.
+
+    Folders are synced under the distributor lock, so a holter moved and indexed
+    meanwhile is not dropped from the index. While a pass is running, they are
+    left for the next call.
+    """
+    output_path = config.get()["output_path"]
+    if doctors is None:
+        doctors = os.listdir(output_path)
+    current_dates = _get_current_dates()
+    for key in [key for key in _folders_mtime if key[1] not in current_dates]:
+        del _folders_mtime[key]
+    changed_folders = []
     for doctor in doctors:
-        data[doctor] = {}
-        doctor_path = os.path.join(config.get()["output_path"], doctor)
-        dates = [
-            datetime.datetime.strptime(date_str, "%d.%m.%Y").date()
-            for date_str in os.listdir(doctor_path)
-        ]
-        for date in dates:
-            if month is not None and date.month != month:
-                continue
-            if year is not None and date.year != year:
+        for date in current_dates:
+            folder_path = os.path.join(output_path, doctor, date.strftime("%d.%m.%Y"))
+            try:
+                mtime = os.stat(folder_path).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if (doctor, date) in _folders_mtime and _folders_mtime[(doctor, date)] == mtime:
                 continue
-            date_path = os.path.join(doctor_path, date.strftime("%d.%m.%Y"))
-            holters = _get_holters_in_folder(date_path)
-            data[doctor][date] = len(holters)
-    return data
-
-
-def _get_holters_in_folder(folder_path, recursive=False) -> t.List[str]:
-    """ Return list of full paths to all .zhr files in the folder. """
-    if recursive:
-        file_names = [
-            os.path.join(root, file_name)
-            for root, _, file_names in os.walk(folder_path)
-            for file_name in file_names
-        ]
-    else:
-        file_names = [
-            os.path.join(folder_path, file_name)
-            for file_name in os.listdir(folder_path)
-        ]
-    return [
-        file_name for file_name in file_names
-        if file_name.lower().endswith(".zhr")
-    ]
+            changed_folders.append((doctor, date, folder_path, mtime))
+    if not changed_folders:
+        return
+    with locks.FileLock(config.get().get("lock_path", "distributor.lock")) as acquired:
+        if not acquired:
+            return
+        for doctor, date, folder_path, mtime in changed_folders:
+            # Listed fresh, as the memoized listing can be older than the change of the folder
+            try:
+                holters = list(scan.iter_holters(folder_path)) if mtime is not None else []
+            except FileNotFoundError:
+                holters = []
+            index.sync_folder(doctor, date, holters)
+            _folders_mtime[(doctor, date)] = mtime
+
+
+def _get_daily_counts(month=None, year=None) -> t.Dict[str, t.Dict[datetime.date, int]]:
+    global _finished_months_built_at
+    today = datetime.date.today()
+    if month is None or year is None or (year, month) >= (today.year, today.month):
+        return index.get_daily_counts(month=month, year=year)
+
+    built_at = index.get_built_at()
+    if built_at != _finished_months_built_at:
+        _finished_months_cache.clear()
+        _finished_months_built_at = built_at
+    if (year, month) not in _finished_months_cache:
+        _finished_months_cache[(year, month)] = index.get_daily_counts(month=month, year=year)
+    return _finished_months_cache[(year, month)]
@@ -0,0 +1,86 @@
+""" Export of the distributed holters with the patients' data for a date range, as CSV.
+
+Usage: python export.py 2025-01-01 2025-12-31 --doctor "Михаил Русланович" --output holters.csv
+
+Holters are read from the index in order and their headers are parsed in chunks,
+so the export takes the same memory for a day and for a year. Patient data comes
+from the patient cache, so repeated exports do not read the holters again.
+"""
+import argparse
+import csv
+import datetime
+import io
+import itertools
+import os
+import sys
+import typing
+
+import config
+import holter
+import index
+
+COLUMNS = ["Date", "Doctor", "File Name", "Name", "Birth Date"]
+CHUNK_SIZE = 500
+
+
+def iter_rows(
+    start: datetime.date, end: datetime.date, doctor: typing.Optional[str] = None
+) -> typing.Iterator[typing.List[str]]:
+    """ Yield [date, doctor, file name, patient name, birth date] of the holters given from start to end. """
+    output_path = config.get()["output_path"]
+    holters = index.iter_holters(start, end, doctor=doctor)
+    while True:
+        chunk = list(itertools.islice(holters, CHUNK_SIZE))
+        if not chunk:
+            return
+        paths = [
+            os.path.join(output_path, holter_doctor, date.strftime("%d.%m.%Y"), holter_name)
+            for date, holter_doctor, holter_name in chunk
+        ]
+        for (date, holter_doctor, holter_name), patient_data in zip(chunk, holter.get_patients_data(paths)):
+            birth_date = patient_data.get('birth_date')
+            yield [
+                date.strftime("%d.%m.%Y"),
+                holter_doctor,
+                holter_name,
+                patient_data['name'],
+                datetime.date.fromisoformat(birth_date).strftime("%d.%m.%Y") if birth_date else "",
+            ]
+
+
+def iter_csv(
+    start: datetime.date, end: datetime.date, doctor: typing.Optional[str] = None
+) -> typing.Iterator[str]:
+    """ Yield CSV text of the export in chunks, starting with the columns row. """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for row in iter_rows(start, end, doctor=doctor):
+        writer.writerow(row)
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("start", type=datetime.date.fromisoformat, help="first date, YYYY-MM-DD")
+    parser.add_argument("end", type=datetime.date.fromisoformat, help="last date, YYYY-MM-DD")
+    parser.add_argument("--doctor", help="doctor's folder name, all doctors if not given")
+    parser.add_argument("--output", help="CSV file, printed to stdout if not given")
+    args = parser.parse_args()
+
+    # BOM lets Excel open the file as UTF-8
+    output = open(args.output, "w", encoding="utf-8-sig", newline="") if args.output else sys.stdout
+    try:
+        for text in iter_csv(args.start, args.end, doctor=args.doctor):
+            output.write(text)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
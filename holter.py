@@ -1,34 +1,36 @@
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
 import os
 import re
 import datetime
 import csv
+import json
 import logging
+import queue
+import sqlite3
+import threading
+import time
 import typing
 
+import config
+import metrics
+import scan
+
 
 logger = logging.getLogger(__name__)
 
+# Patient data is written in the beginning of the file, right before this marker
+HEADER_MARKER = 'Регистратор Philips'.encode("windows-1251")
+HEADER_SIZE = 8 * 1024
+
 
 def get_in_folder(folder_path, recursive=False) -> typing.List[str]:
     """ Return list of full paths to all .zhr files in the folder. """
-    if recursive:
-        file_names = [
-            os.path.join(root, file_name)
-            for root, _, file_names in os.walk(folder_path)
-            for file_name in file_names
-        ]
-    else:
-        file_names = [
-            os.path.join(folder_path, file_name)
-            for file_name in os.listdir(folder_path)
-        ]
-    return [
-        file_name for file_name in file_names
-        if file_name.lower().endswith(".zhr")
-    ]
-
-
-# keeping this in order to be able to extract birth date in the future
+    return [holter.path for holter in scan.iter_holters(folder_path, recursive=recursive)]
+
+
 def _extract_date(input_string):
     date_pattern = r'\b\d{2}\.\d{2}\.\d{4}\b'
     match = re.search(date_pattern, input_string)
@@ -54,25 +56,150 @@ def _extract_name(input_string):
     return ' '.join(words)
 
 
-def get_patient_data(path: str):
-    try:
-        lines = []
-        with open(path, mode='r', encoding="windows-1251", errors="ignore") as f:
-            for i, l in enumerate(f):
-                lines.append(l)
-                if 'Регистратор Philips' in l:
-                    break
-                if i > 50:
-                    raise Exception('Cannot find data in the first 50 lines')
-
-        name = _extract_name(lines[-2])
-        if len(name) < 4:
-            name_2 = _extract_name(lines[-1])
-            if len(name_2) > len(name):
-                name = name_2
+class PatientDataCache:
+    """ LRU cache of parsed patient data keyed by holter path, mtime and size.
+
+    If path is given, entries are also stored in SQLite database, so they
+    survive restarts and the holter file is parsed once for its whole life.
+    """
+
+    def __init__(self, max_size: int = 10000, path: typing.Optional[str] = None):
+        self.max_size = max_size
+        self.path = path
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            with self._connect() as connection:
+                # Distributor daemon writes prefetched data while web workers read it
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS patients ("
+                    "path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, data TEXT NOT NULL)"
+                )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, path: str, mtime: float, size: int) -> typing.Optional[dict]:
+        key = (path, mtime, size)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        if not self.path:
+            return None
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT data FROM patients WHERE path = ? AND mtime = ? AND size = ?", key
+            ).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        self._remember(key, data)
+        return data
+
+    def set(self, path: str, mtime: float, size: int, data: dict):
+        self._remember((path, mtime, size), data)
+        if self.path:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO patients (path, mtime, size, data) VALUES (?, ?, ?, ?)",
+                    (path, mtime, size, json.dumps(data, ensure_ascii=False)),
+                )
+
+    def _remember(self, key, data: dict):
+        with self._lock:
+            self._items[key] = data
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+_cache = None
+
+
+def _get_cache() -> PatientDataCache:
+    global _cache
+    if _cache is None:
+        _config = config.get()
+        _cache = PatientDataCache(
+            max_size=_config.get("patient_cache_size", 10000),
+            path=_config.get("patient_cache_path", "patients.sqlite3"),
+        )
+    return _cache
+
+
+@dataclasses.dataclass
+class Header:
+    name: str
+    birth_date: typing.Optional[datetime.date] = None
+
+
+def _find_line_start(data: bytes, end: int) -> int:
+    return max(data.rfind(b'\n', 0, end), data.rfind(b'\r', 0, end)) + 1
+
+
+def read_header(path: str) -> typing.Optional[Header]:
+    """ Read patient data from the first bytes of the holter, return None if there is no data. """
+    with open(path, mode='rb') as f:
+        data = f.read(HEADER_SIZE)
+    marker_position = data.find(HEADER_MARKER)
+    if marker_position == -1:
+        return None
+
+    # Patient name is on the line before the marker, sometimes on the marker line itself
+    marker_line_start = _find_line_start(data, marker_position)
+    marker_line_end = min(
+        position for position in (data.find(b'\n', marker_position), data.find(b'\r', marker_position), len(data))
+        if position != -1
+    )
+    previous_line_end = marker_line_start - 1
+    if data[marker_line_start - 2:marker_line_start] == b'\r\n':
+        previous_line_end -= 1
+    previous_line_end = max(previous_line_end, 0)
+    previous_line_start = _find_line_start(data, previous_line_end)
+
+    previous_line = data[previous_line_start:previous_line_end].decode("windows-1251", errors="ignore")
+    marker_line = data[marker_line_start:marker_line_end].decode("windows-1251", errors="ignore")
+
+    name = _extract_name(previous_line)
+    if len(name) < 4:
+        name_2 = _extract_name(marker_line)
+        if len(name_2) > len(name):
+            name = name_2
+    return Header(
+        name=name,
+        birth_date=_extract_date(previous_line) or _extract_date(marker_line),
+    )
+
+
+def _read_patient_data(path: str):
+    header = read_header(path)
+    if header is None:
         return {
-            'name': name,
+            'name': 'Unknown',
+            'birth_date': None,
         }
+    return {
+        'name': header.name,
+        'birth_date': header.birth_date.isoformat() if header.birth_date else None,
+    }
+
+
+def get_patient_data(path: str):
+    try:
+        stat = os.stat(path)
+        data = _get_cache().get(path, stat.st_mtime, stat.st_size)
+        if data is None:
+            data = _read_patient_data(path)
+            _get_cache().set(path, stat.st_mtime, stat.st_size, data)
+        return data
     except Exception as e:
         logger.error(f"Error processing file {path}: {e}")
         return {
@@ -80,6 +207,162 @@ def get_patient_data(path: str):
         }
 
 
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.get().get("patient_data_workers", 8),
+                thread_name_prefix="patient-data",
+            )
+    return _executor
+
+
+def get_patients_data(paths: typing.List[str]) -> typing.List[dict]:
+    """ Return patient data of the holters in the same order as paths.
+
+    Files are read by a bounded thread pool, so latency of the network share
+    overlaps instead of adding up.
+    """
+    if len(paths) <= 1:
+        return [get_patient_data(path) for path in paths]
+    return list(_get_executor().map(get_patient_data, paths))
+
+
+class HeaderPrefetcher:
+    """ Parses headers of the just distributed holters in the background.
+
+    Right after the move the file is still in the OS page cache, and its patient
+    data gets to the persistent cache before anybody opens the daily page. The
+    queue is bounded: when it is full, holters are dropped and parsed on demand.
+    """
+
+    def __init__(self, max_queue: int, workers: int):
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._workers = workers
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopped = False
+        self.done = 0
+        self.dropped = 0
+        # Seconds from queueing to parsing
+        self.last_lag = None
+        self.max_lag = 0.0
+
+    def submit(self, paths: typing.List[str]):
+        if not self._start():
+            return
+        for path in paths:
+            try:
+                self._queue.put_nowait((path, time.monotonic()))
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                metrics.HEADER_PREFETCHES.inc(result="dropped")
+
+    def _start(self) -> bool:
+        """ Start the workers if they are not running, return False if the prefetcher was stopped. """
+        with self._lock:
+            if self._stopped:
+                return False
+            while len(self._threads) < self._workers:
+                thread = threading.Thread(target=self._run, name="header-prefetch", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            path, queued_at = item
+            try:
+                get_patient_data(path)
+            finally:
+                lag = time.monotonic() - queued_at
+                with self._lock:
+                    self.done += 1
+                    self.last_lag = lag
+                    self.max_lag = max(self.max_lag, lag)
+                metrics.HEADER_PREFETCHES.inc(result="done")
+                metrics.HEADER_PREFETCH_LAG_SECONDS.observe(lag)
+                self._queue.task_done()
+
+    def join(self):
+        """ Wait until all queued holters are parsed. """
+        self._queue.join()
+
+    def stop(self, timeout: typing.Optional[float] = None):
+        """ Drop the queued holters, wait for the workers to finish the ones being parsed and stop them. """
+        with self._lock:
+            self._stopped = True
+            threads, self._threads = self._threads, []
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._queue.task_done()
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "done": self.done,
+                "dropped": self.dropped,
+                "last_lag": round(self.last_lag, 3) if self.last_lag is not None else None,
+                "max_lag": round(self.max_lag, 3),
+            }
+
+
+_prefetcher = None
+
+
+def _get_prefetcher() -> typing.Optional[HeaderPrefetcher]:
+    global _prefetcher
+    with _executor_lock:
+        if _prefetcher is None:
+            _config = config.get()
+            max_queue = _config.get("prefetch_queue_size", 1000)
+            if max_queue <= 0:
+                return None
+            _prefetcher = HeaderPrefetcher(max_queue, workers=_config.get("prefetch_workers", 2))
+    return _prefetcher
+
+
+def prefetch_headers(paths: typing.List[str]):
+    """ Queue holters for parsing of their headers in the background, without waiting. """
+    prefetcher = _get_prefetcher()
+    if prefetcher is not None and paths:
+        prefetcher.submit(paths)
+
+
+def stop_prefetch(timeout: typing.Optional[float] = None):
+    """ Stop the background parsing, before the process exits or the patients cache is removed. """
+    global _prefetcher
+    with _executor_lock:
+        prefetcher, _prefetcher = _prefetcher, None
+    if prefetcher is not None:
+        prefetcher.stop(timeout)
+
+
+def get_prefetch_stats() -> dict:
+    prefetcher = _get_prefetcher()
+    if prefetcher is None:
+        return {"queue_depth": 0, "done": 0, "dropped": 0, "last_lag": None, "max_lag": 0.0}
+    return prefetcher.get_stats()
+
+
 if __name__ == "__main__":
     # Example usage
     path = "/Users/pavel.m/Projects/telecardio/output/Михаил Русланович/12.07.2025/ABSYV2AWA6.ZHR"
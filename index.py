@@ -0,0 +1,297 @@
+""" Local SQLite index of the holters distributed to the doctors.
+
+The index mirrors the output folder (<output_path>/<doctor>/<dd.mm.YYYY>/<holter>),
+so duplicate detection and statistics do not need to walk the whole output tree.
+It is written on every move and can be rebuilt from disk at any time.
+"""
+import contextlib
+import datetime
+import os
+import sqlite3
+import typing
+
+import config
+import scan
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS holters (
+    key TEXT NOT NULL,
+    name TEXT NOT NULL,
+    doctor TEXT NOT NULL,
+    date TEXT,
+    station TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (doctor, date, key)
+);
+CREATE INDEX IF NOT EXISTS holters_key ON holters (key);
+CREATE INDEX IF NOT EXISTS holters_date ON holters (date, doctor);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_counts (
+    doctor TEXT NOT NULL,
+    date TEXT NOT NULL,
+    station TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (date, doctor, station)
+);
+CREATE TRIGGER IF NOT EXISTS holters_insert AFTER INSERT ON holters WHEN NEW.date IS NOT NULL
+BEGIN
+    INSERT OR IGNORE INTO daily_counts (doctor, date, station, count) VALUES (NEW.doctor, NEW.date, NEW.station, 0);
+    UPDATE daily_counts SET count = count + 1
+    WHERE doctor = NEW.doctor AND date = NEW.date AND station = NEW.station;
+END;
+CREATE TRIGGER IF NOT EXISTS holters_delete AFTER DELETE ON holters WHEN OLD.date IS NOT NULL
+BEGIN
+    UPDATE daily_counts SET count = count - 1
+    WHERE doctor = OLD.doctor AND date = OLD.date AND station = OLD.station;
+    DELETE FROM daily_counts
+    WHERE doctor = OLD.doctor AND date = OLD.date AND station = OLD.station AND count <= 0;
+END;
+"""
+
+_prepared_paths = set()
+
+
+def _get_index_path() -> str:
+    return config.get().get("index_path", "holters.sqlite3")
+
+
+def _parse_date(date_str: str) -> typing.Optional[datetime.date]:
+    try:
+        return datetime.datetime.strptime(date_str, "%d.%m.%Y").date()
+    except ValueError:
+        return None
+
+
+@contextlib.contextmanager
+def _connect():
+    """ Open index connection, create and fill the index on the first use. """
+    path = _get_index_path()
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        if path not in _prepared_paths:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            has_daily_counts = connection.execute("SELECT 1 FROM meta WHERE key = 'daily_counts'").fetchone()
+            if not has_daily_counts:
+                # Index was created before daily counts were kept, fill them from the holters
+                with connection:
+                    connection.execute("DELETE FROM daily_counts")
+                    connection.execute(
+                        "INSERT INTO daily_counts (doctor, date, station, count) "
+                        "SELECT doctor, date, station, COUNT(*) FROM holters WHERE date IS NOT NULL "
+                        "GROUP BY doctor, date, station"
+                    )
+                    connection.execute("INSERT INTO meta (key, value) VALUES ('daily_counts', '1')")
+            is_built = connection.execute("SELECT 1 FROM meta WHERE key = 'built_at'").fetchone()
+            if not is_built:
+                with connection:
+                    _rebuild(connection)
+            _prepared_paths.add(path)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def _make_row(doctor: str, date: typing.Optional[datetime.date], holter: scan.HolterFile):
+    return (
+        holter.name.lower(),
+        holter.name,
+        doctor,
+        date.isoformat() if date else None,
+        holter.station,
+        holter.size,
+        holter.mtime,
+    )
+
+
+def _make_row_from_path(doctor: str, date: typing.Optional[datetime.date], holter_path: str):
+    stat = os.stat(holter_path)
+    holter = scan.HolterFile(holter_path, os.path.basename(holter_path), stat.st_size, stat.st_mtime)
+    return _make_row(doctor, date, holter)
+
+
+def _insert(connection, rows):
+    # Upsert instead of INSERT OR REPLACE, as replace does not fire the delete trigger
+    connection.executemany(
+        "INSERT INTO holters (key, name, doctor, date, station, size, mtime) VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (doctor, date, key) DO UPDATE SET name = excluded.name, size = excluded.size, "
+        "mtime = excluded.mtime",
+        rows,
+    )
+
+
+def _bump_version(connection):
+    connection.execute(
+        "INSERT INTO meta (key, value) VALUES ('version', 1) ON CONFLICT (key) DO UPDATE SET value = value + 1"
+    )
+
+
+def _rebuild(connection) -> int:
+    output_path = config.get()["output_path"]
+    rows = []
+    try:
+        for holter in scan.iter_holters(output_path, recursive=True):
+            relative_parts = os.path.relpath(os.path.dirname(holter.path), output_path).split(os.sep)
+            if relative_parts == ["."]:
+                continue
+            doctor = relative_parts[0]
+            date = _parse_date(relative_parts[1]) if len(relative_parts) == 2 else None
+            rows.append(_make_row(doctor, date, holter))
+    except FileNotFoundError:
+        print(f"WARNING! Output folder {output_path} does not exist.")
+    connection.execute("DELETE FROM holters")
+    _insert(connection, rows)
+    _bump_version(connection)
+    connection.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('built_at', ?)",
+        (datetime.datetime.now().isoformat(),),
+    )
+    return len(rows)
+
+
+def rebuild() -> int:
+    """ Re-create the index from the output folder, return number of indexed holters. """
+    with _connect() as connection:
+        return _rebuild(connection)
+
+
+def add_holters(holters: typing.List[typing.Tuple[str, datetime.date, str]]):
+    """ Register (doctor, date, holter path) of the holters moved to the doctors' folders. """
+    rows = []
+    for doctor, date, holter_path in holters:
+        try:
+            rows.append(_make_row_from_path(doctor, date, holter_path))
+        except OSError:
+            continue
+    with _connect() as connection:
+        _insert(connection, rows)
+        _bump_version(connection)
+
+
+def sync_folder(doctor: str, date: datetime.date, holters: typing.List[scan.HolterFile]):
+    """ Make index rows of the doctor's folder for the date match the holters on disk. """
+    rows = [_make_row(doctor, date, holter) for holter in holters]
+    with _connect() as connection:
+        connection.execute("DELETE FROM holters WHERE doctor = ? AND date = ?", (doctor, date.isoformat()))
+        _insert(connection, rows)
+        _bump_version(connection)
+
+
+def get_built_at() -> str:
+    """ Return when the index was last rebuilt from disk. """
+    with _connect() as connection:
+        row = connection.execute("SELECT value FROM meta WHERE key = 'built_at'").fetchone()
+    return row[0]
+
+
+def find_built_at() -> typing.Optional[str]:
+    """ Return when the index was last rebuilt, None if it is not built yet. Unlike get_built_at, never builds it. """
+    path = _get_index_path()
+    if not os.path.exists(path):
+        return None
+    connection = sqlite3.connect(path, timeout=1)
+    try:
+        row = connection.execute("SELECT value FROM meta WHERE key = 'built_at'").fetchone()
+    except sqlite3.OperationalError:
+        # meta table is not created yet, or the index is locked by its creation
+        return None
+    finally:
+        connection.close()
+    return row[0] if row else None
+
+
+def get_version() -> int:
+    """ Return number which changes on every write to the index. """
+    with _connect() as connection:
+        row = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def contains(holter_name: str) -> bool:
+    """ Return True if holter with such name (case-insensitive) was already distributed. """
+    with _connect() as connection:
+        row = connection.execute(
+            "SELECT 1 FROM holters WHERE key = ? LIMIT 1", (holter_name.lower(),)
+        ).fetchone()
+    return row is not None
+
+
+def _get_date_condition(month=None, year=None):
+    if year is not None and month is not None:
+        start = datetime.date(year, month, 1)
+        end = datetime.date(year + 1, 1, 1) if month == 12 else datetime.date(year, month + 1, 1)
+        return "date >= ? AND date < ?", [start.isoformat(), end.isoformat()]
+    conditions, params = ["date IS NOT NULL"], []
+    if year is not None:
+        conditions.append("substr(date, 1, 4) = ?")
+        params.append(f"{year:04d}")
+    if month is not None:
+        conditions.append("substr(date, 6, 2) = ?")
+        params.append(f"{month:02d}")
+    return " AND ".join(conditions), params
+
+
+def get_daily_counts(month=None, year=None) -> typing.Dict[str, typing.Dict[datetime.date, int]]:
+    """ Return how many holters each doctor have per day """
+    condition, params = _get_date_condition(month=month, year=year)
+    with _connect() as connection:
+        rows = connection.execute(
+            f"SELECT doctor, date, SUM(count) FROM daily_counts WHERE {condition} GROUP BY doctor, date",
+            params,
+        ).fetchall()
+    data = {}
+    for doctor, date_str, count in rows:
+        data.setdefault(doctor, {})[datetime.date.fromisoformat(date_str)] = count
+    return data
+
+
+def get_monthly_counts(year: int) -> typing.Dict[str, typing.Dict[int, int]]:
+    """ Return how many holters each doctor have per month of the year """
+    condition, params = _get_date_condition(year=year)
+    with _connect() as connection:
+        rows = connection.execute(
+            f"SELECT doctor, CAST(substr(date, 6, 2) AS INTEGER), SUM(count) FROM daily_counts "
+            f"WHERE {condition} GROUP BY doctor, substr(date, 6, 2)",
+            params,
+        ).fetchall()
+    data = {}
+    for doctor, month, count in rows:
+        data.setdefault(doctor, {})[month] = count
+    return data
+
+
+def get_holter_names(doctor: str, date: datetime.date) -> typing.List[str]:
+    """ Return names of the holters given to the doctor on the date. """
+    with _connect() as connection:
+        rows = connection.execute(
+            "SELECT name FROM holters WHERE doctor = ? AND date = ? ORDER BY name",
+            (doctor, date.isoformat()),
+        ).fetchall()
+    return [name for name, in rows]
+
+
+def iter_holters(
+    start: datetime.date, end: datetime.date, doctor: typing.Optional[str] = None
+) -> typing.Iterator[typing.Tuple[datetime.date, str, str]]:
+    """ Yield (date, doctor, holter name) of the holters given from start to end inclusive, ordered by them. """
+    condition, params = "date >= ? AND date <= ?", [start.isoformat(), end.isoformat()]
+    if doctor is not None:
+        condition += " AND doctor = ?"
+        params.append(doctor)
+    with _connect() as connection:
+        cursor = connection.execute(
+            f"SELECT date, doctor, name FROM holters WHERE {condition} ORDER BY date, doctor, name", params
+        )
+        for date_str, row_doctor, name in cursor:
+            yield datetime.date.fromisoformat(date_str), row_doctor, name
+
+
+if __name__ == "__main__":
+    print("Rebuilding holters index...")
+    print(f"Indexed {rebuild()} holters.")
@@ -0,0 +1,170 @@
+""" Ingestion of the holters from the input folder.
+
+Recorder stations upload holters over the network, so a file can appear in the
+input folder long before it is completely written. StableFiles keeps every
+candidate in memory and releases it only when its size and mtime have not
+changed for the quiet window.
+
+Every input folder (one per clinic) is scanned by its own worker thread, so a
+slow network share delays only its own holters, not the holters of the others.
+"""
+import collections
+import concurrent.futures
+import dataclasses
+import threading
+import time
+import typing
+
+import metrics
+import scan
+
+
+@dataclasses.dataclass
+class _Candidate:
+    size: int
+    mtime: float
+    first_seen: float
+    changed_at: float
+
+
+class StableFiles:
+    def __init__(self, quiet_seconds: float):
+        self.quiet_seconds = quiet_seconds
+        self.pending: typing.Dict[str, _Candidate] = {}
+        # Seconds between the first observation and the release of the recent holters
+        self.time_to_stable = collections.deque(maxlen=100)
+        self._lock = threading.Lock()
+
+    def observe(self, holters: typing.List[scan.HolterFile]) -> typing.List[str]:
+        """ Update pending table with the current files, return paths of files that became stable. """
+        now = time.monotonic()
+        stable = []
+        with self._lock:
+            for path in set(self.pending) - {holter.path for holter in holters}:
+                del self.pending[path]
+            for holter in holters:
+                path = holter.path
+                candidate = self.pending.get(path)
+                if candidate is None:
+                    candidate = self.pending[path] = _Candidate(holter.size, holter.mtime, now, now)
+                elif (candidate.size, candidate.mtime) != (holter.size, holter.mtime):
+                    candidate.size, candidate.mtime, candidate.changed_at = holter.size, holter.mtime, now
+                if now - candidate.changed_at >= self.quiet_seconds:
+                    stable.append(path)
+            for path in stable:
+                time_to_stable = now - self.pending.pop(path).first_seen
+                self.time_to_stable.append(time_to_stable)
+                metrics.INPUT_TIME_TO_STABLE_SECONDS.observe(time_to_stable)
+        return stable
+
+    def get_next_release_delay(self) -> typing.Optional[float]:
+        """ Return seconds until the next pending file can become stable, None if nothing is pending. """
+        with self._lock:
+            if not self.pending:
+                return None
+            changed_at = min(candidate.changed_at for candidate in self.pending.values())
+        return max(0.0, changed_at + self.quiet_seconds - time.monotonic())
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            time_to_stable = list(self.time_to_stable)
+            pending = len(self.pending)
+        return {
+            "pending": pending,
+            "last_time_to_stable": round(time_to_stable[-1], 2) if time_to_stable else None,
+            "average_time_to_stable": (
+                round(sum(time_to_stable) / len(time_to_stable), 2) if time_to_stable else None
+            ),
+        }
+
+
+@dataclasses.dataclass
+class ScanResult:
+    # All holters found in the scanned folders
+    holters: typing.List[str] = dataclasses.field(default_factory=list)
+    # Holters that became stable
+    stable: typing.List[str] = dataclasses.field(default_factory=list)
+    # Folders which scan did not finish within the timeout
+    unscanned: typing.List[str] = dataclasses.field(default_factory=list)
+
+
+class _Source:
+    def __init__(self, folder_path: str, quiet_seconds: float):
+        self.folder_path = folder_path
+        self.stable_files = StableFiles(quiet_seconds)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="input-scan")
+        self.future = None
+
+    def scan(self, list_holters: typing.Callable[[str], typing.List[scan.HolterFile]]):
+        holters = list_holters(self.folder_path)
+        return [holter.path for holter in holters], self.stable_files.observe(holters)
+
+
+class InputSources:
+    """ Scans input folders concurrently, each by its own worker thread.
+
+    The scan of a folder that does not finish within the timeout keeps running,
+    its result is taken by one of the next scans.
+    """
+
+    def __init__(self, quiet_seconds: float):
+        self.quiet_seconds = quiet_seconds
+        self._sources: typing.Dict[str, _Source] = {}
+        self._lock = threading.Lock()
+
+    def scan(
+        self,
+        folder_paths: typing.List[str],
+        list_holters: typing.Callable[[str], typing.List[scan.HolterFile]],
+        timeout: float,
+    ) -> ScanResult:
+        with self._lock:
+            for folder_path in set(self._sources) - set(folder_paths):
+                self._sources.pop(folder_path).executor.shutdown(wait=False)
+            sources = []
+            for folder_path in folder_paths:
+                source = self._sources.get(folder_path)
+                if source is None:
+                    source = self._sources[folder_path] = _Source(folder_path, self.quiet_seconds)
+                source.stable_files.quiet_seconds = self.quiet_seconds
+                if source.future is None:
+                    source.future = source.executor.submit(source.scan, list_holters)
+                sources.append(source)
+            futures = [source.future for source in sources]
+
+        concurrent.futures.wait(futures, timeout=timeout)
+        result = ScanResult()
+        with self._lock:
+            for source, future in zip(sources, futures):
+                if not future.done():
+                    result.unscanned.append(source.folder_path)
+                    continue
+                source.future = None
+                try:
+                    holters, stable = future.result()
+                except Exception as e:
+                    print(f"ERROR! Failed to scan input folder {source.folder_path}. Error: {e}")
+                    continue
+                result.holters += holters
+                result.stable += stable
+        return result
+
+    def get_next_release_delay(self) -> typing.Optional[float]:
+        """ Return seconds until the next pending file of any folder can become stable, None if nothing is pending. """
+        with self._lock:
+            sources = list(self._sources.values())
+        delays = [source.stable_files.get_next_release_delay() for source in sources]
+        return min((delay for delay in delays if delay is not None), default=None)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            sources = list(self._sources.values())
+        folders = {source.folder_path: source.stable_files.get_stats() for source in sources}
+        time_to_stable = [value for source in sources for value in list(source.stable_files.time_to_stable)]
+        return {
+            "pending": sum(stats["pending"] for stats in folders.values()),
+            "average_time_to_stable": (
+                round(sum(time_to_stable) / len(time_to_stable), 2) if time_to_stable else None
+            ),
+            "folders": folders,
+        }
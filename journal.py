@@ -0,0 +1,220 @@
+""" Write-ahead journal of the distribution moves.
+
+Every move of a pass is appended to the journal and synced to disk before the
+moves start, and marked done or failed after the holter is moved and indexed.
+The pass ends with a checkpoint, so after a crash only the records after the
+last checkpoint have to be reconciled, by looking at their source and target
+files, without walking the output tree.
+
+Records are JSON lists, one per line:
+    ["P", id, time, source path, target folder, doctor, date]  planned move
+    ["D", id]                                                  move is done
+    ["F", id]                                                  move failed
+    ["C", time]                                                checkpoint, all moves above are finished
+
+Ids are unique between two checkpoints. The journal is append-only, so it is
+also the history of the distribution, which can be replayed with iter_done.
+
+Usage: python journal.py  prints holters moved per day and doctor from the journal
+"""
+import collections
+import dataclasses
+import datetime
+import json
+import os
+import time
+import typing
+
+import config
+
+
+@dataclasses.dataclass
+class Entry:
+    id: int
+    time: float
+    source_path: str
+    target_folder: str
+    # Doctor's folder name and the date, None for rejected holters
+    doctor: typing.Optional[str] = None
+    date: typing.Optional[datetime.date] = None
+
+    @property
+    def target_path(self):
+        return os.path.join(self.target_folder, os.path.basename(self.source_path))
+
+
+def _get_path() -> str:
+    return config.get().get("journal_path", "distribution.journal")
+
+
+def _parse(line: str):
+    try:
+        return json.loads(line)
+    except ValueError:
+        # last line written partially by a crash
+        return None
+
+
+def _make_entry(record) -> Entry:
+    _, entry_id, entry_time, source_path, target_folder, doctor, date = record
+    return Entry(
+        entry_id, entry_time, source_path, target_folder, doctor, datetime.date.fromisoformat(date) if date else None
+    )
+
+
+class Journal:
+    def __init__(self, path: typing.Optional[str] = None):
+        self.path = path or _get_path()
+        self._file = None
+        self._next_id = 0
+
+    def __enter__(self):
+        # Ids continue after the unfinished moves, so they stay unique until the next checkpoint
+        records = [_parse(line) for line in _read_tail(self.path)]
+        self._next_id = max((record[1] + 1 for record in records if record and record[0] == "P"), default=0)
+        self._file = open(self.path, "a", encoding="utf-8")
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+        self._file = None
+
+    def _write(self, records, sync: bool):
+        self._file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def plan(
+        self, moves: typing.List[typing.Tuple[str, str, typing.Optional[str], typing.Optional[datetime.date]]]
+    ) -> typing.List[Entry]:
+        """ Append (source path, target folder, doctor, date) moves and sync them to disk before they are made. """
+        now = time.time()
+        entries = []
+        for source_path, target_folder, doctor, date in moves:
+            entries.append(Entry(self._next_id, now, source_path, target_folder, doctor, date))
+            self._next_id += 1
+        self._write([
+            ["P", entry.id, round(entry.time, 3), entry.source_path, entry.target_folder, entry.doctor,
+             entry.date.isoformat() if entry.date else None]
+            for entry in entries
+        ], sync=True)
+        return entries
+
+    def finish(self, done: typing.List[Entry], failed: typing.List[Entry]):
+        """ Mark moves as done or failed and write the checkpoint. """
+        self._write(
+            [["D", entry.id] for entry in done] + [["F", entry.id] for entry in failed] + [["C", round(time.time(), 3)]],
+            sync=True,
+        )
+
+
+def _read_tail(path: str) -> typing.List[str]:
+    """ Return lines of the journal after the last checkpoint, reading it from the end. """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        size = f.seek(0, os.SEEK_END)
+        block_size = 64 * 1024
+        while True:
+            start = max(0, size - block_size)
+            f.seek(start)
+            lines = f.read(size - start).decode("utf-8", errors="replace").splitlines()
+            if start > 0:
+                # first line can be cut in the middle
+                lines = lines[1:]
+            for i in range(len(lines) - 1, -1, -1):
+                if lines[i].startswith('["C"'):
+                    return lines[i + 1:]
+            if start == 0:
+                return lines
+            block_size *= 2
+
+
+def get_unfinished(path: typing.Optional[str] = None) -> typing.List[Entry]:
+    """ Return planned moves after the last checkpoint which were not marked done or failed. """
+    entries = {}
+    for line in _read_tail(path or _get_path()):
+        record = _parse(line)
+        if not record:
+            continue
+        if record[0] == "P":
+            entry = _make_entry(record)
+            entries[entry.id] = entry
+        elif record[0] in ("D", "F"):
+            entries.pop(record[1], None)
+    return list(entries.values())
+
+
+def recover(path: typing.Optional[str] = None) -> typing.List[Entry]:
+    """ Reconcile moves interrupted by a crash, return entries of the holters which ended in the target folder.
+
+    Must be called by the distributor holding the lock, before every pass.
+    """
+    path = path or _get_path()
+    unfinished = get_unfinished(path)
+    if not unfinished:
+        return []
+    moved = []
+    for entry in unfinished:
+        temp_path = entry.target_path + ".part"
+        if os.path.exists(temp_path):
+            print(f"Recovery: removing partial copy {temp_path}")
+            os.remove(temp_path)
+        source_exists = os.path.exists(entry.source_path)
+        target_exists = os.path.exists(entry.target_path)
+        if source_exists and target_exists:
+            if os.path.getsize(entry.source_path) == os.path.getsize(entry.target_path):
+                # Copy was completed, but the source was not removed
+                print(f"Recovery: removing source of copied holter {entry.source_path}")
+                os.remove(entry.source_path)
+                moved.append(entry)
+            else:
+                print(f"Recovery: removing incomplete holter {entry.target_path}")
+                os.remove(entry.target_path)
+        elif target_exists:
+            moved.append(entry)
+        elif not source_exists:
+            print(f"WARNING! Recovery: holter {entry.source_path} is neither in the source nor in {entry.target_folder}")
+    moved_ids = {entry.id for entry in moved}
+    with Journal(path) as journal:
+        journal.finish(moved, [entry for entry in unfinished if entry.id not in moved_ids])
+    return moved
+
+
+def iter_done(
+    since: typing.Optional[datetime.datetime] = None, path: typing.Optional[str] = None
+) -> typing.Iterator[Entry]:
+    """ Replay the journal, yield moves which were done, in the order they were planned. """
+    since_time = since.timestamp() if since else None
+    try:
+        f = open(path or _get_path(), encoding="utf-8")
+    except FileNotFoundError:
+        return
+    with f:
+        planned = {}
+        for line in f:
+            record = _parse(line)
+            if not record:
+                continue
+            if record[0] == "P":
+                if since_time is None or record[2] >= since_time:
+                    planned[record[1]] = record
+            elif record[0] == "D":
+                record = planned.pop(record[1], None)
+                if record:
+                    yield _make_entry(record)
+            elif record[0] == "F":
+                planned.pop(record[1], None)
+            elif record[0] == "C":
+                planned.clear()
+
+
+if __name__ == "__main__":
+    counts = collections.Counter(
+        (entry.date, entry.doctor) for entry in iter_done() if entry.doctor is not None
+    )
+    for (date, doctor), count in sorted(counts.items()):
+        print(f"{date.strftime('%d.%m.%Y')}\t{doctor}\t{count}")
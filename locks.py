@@ -0,0 +1,67 @@
+""" Cross-process file locks. """
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """ Non-blocking exclusive lock on a file, released automatically when the process dies. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def acquire(self, timeout: float = 0) -> bool:
+        """ Try to take the lock for up to timeout seconds, return False if another process holds it. """
+        if self._file is not None:
+            raise RuntimeError(f"Lock {self.path} is already acquired")
+        deadline = time.monotonic() + timeout
+        f = open(self.path, "a+")
+        while True:
+            try:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    f.close()
+                    return False
+                time.sleep(0.05)
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+    def is_held(self) -> bool:
+        """ Return True if another process holds the lock now. """
+        if not self.acquire():
+            return True
+        self.release()
+        return False
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,120 @@
+""" In-process counters and histograms, rendered in Prometheus text format. """
+import contextlib
+import threading
+import time
+import typing
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _format_labels(labels: typing.Tuple[typing.Tuple[str, str], ...], **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> typing.List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        # labels -> (count per bucket, sum, count)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            bucket_counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            self._values[key] = (bucket_counts, total + value, count + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> typing.List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (bucket_counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(labels, le=bound)} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(labels, le='+Inf')} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+def render_gauge(name: str, help_text: str, value: float) -> typing.List[str]:
+    """ Render gauge which value is computed at the moment of the scrape. """
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+
+
+def render(selected=None, exclude=()) -> str:
+    """ Render all the metrics of the process, or only the selected ones, except the excluded. """
+    lines = []
+    for metric in _registry if selected is None else selected:
+        if metric not in exclude:
+            lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+DISTRIBUTION_PASSES = Counter("telecardio_distribution_passes_total", "Distribution passes made.")
+DISTRIBUTION_PHASE_SECONDS = Histogram(
+    "telecardio_distribution_phase_seconds",
+    "Duration of the distribution pass phases: doctors_scan, input_scan, duplicate_check, rule_evaluation, moves.",
+)
+HOLTERS_MOVED = Counter("telecardio_holters_moved_total", "Holters moved by the distributor, by method.")
+HOLTERS_MOVED_BYTES = Counter("telecardio_holters_moved_bytes_total", "Bytes of the holters moved by the distributor.")
+STATS_PHASE_SECONDS = Histogram(
+    "telecardio_stats_phase_seconds",
+    "Duration of the stats views phases: metadata_scan, header_parsing.",
+)
+HEADER_PREFETCHES = Counter(
+    "telecardio_header_prefetches_total", "Holters queued for header parsing after distribution, by result."
+)
+HEADER_PREFETCH_LAG_SECONDS = Histogram(
+    "telecardio_header_prefetch_lag_seconds", "Seconds from queueing a distributed holter to parsing its header."
+)
+INPUT_TIME_TO_STABLE_SECONDS = Histogram(
+    "telecardio_input_time_to_stable_seconds",
+    "Seconds from the first sight of a holter in the input folder until it stopped changing.",
+    buckets=(1, 5, 10, 15, 30, 60, 120, 300, 600, 1800),
+)
+
+# Recorded by the process making the distribution passes, which is the distributor daemon in serve mode
+DISTRIBUTOR_METRICS = (
+    DISTRIBUTION_PASSES, DISTRIBUTION_PHASE_SECONDS, HOLTERS_MOVED, HOLTERS_MOVED_BYTES,
+    HEADER_PREFETCHES, HEADER_PREFETCH_LAG_SECONDS, INPUT_TIME_TO_STABLE_SECONDS,
+)
@@ -1,12 +1,25 @@
+import collections
 import dataclasses
 import datetime
+import heapq
+import json
 import os
 import random
-import shutil
-import typing
+import sys
 import time
+import traceback
+import typing
 
 import config
+import holter
+import index
+import ingest
+import journal
+import locks
+import metrics
+import mover
+import scan
+import watcher
 
 
 def _current_date():
@@ -16,23 +29,8 @@ def _current_date():
     ).date()
 
 
-def _get_holters_in_folder(folder_path, recursive=False) -> typing.List[str]:
-    """ Return list of full paths to all .zhr files in the folder. """
-    if recursive:
-        file_names = [
-            os.path.join(root, file_name)
-            for root, _, file_names in os.walk(folder_path)
-            for file_name in file_names
-        ]
-    else:
-        file_names = [
-            os.path.join(folder_path, file_name)
-            for file_name in os.listdir(folder_path)
-        ]
-    return [
-        file_name for file_name in file_names
-        if file_name.lower().endswith(".zhr")
-    ]
+def _get_station(holter_name: str) -> str:
+    return holter_name[:2]
 
 
 @dataclasses.dataclass
@@ -44,93 +42,475 @@ class Doctor:
     stations_limits: typing.Optional[typing.Dict[str, int]] = None
     is_working: bool = True
     days_off: typing.Optional[typing.List[str]]= None
+    # Rules compiled from the fields above, so checks are O(1) per holter
+    _days_off_dates: typing.FrozenSet[datetime.date] = dataclasses.field(init=False, repr=False)
+    _skip_stations_set: typing.FrozenSet[str] = dataclasses.field(init=False, repr=False)
+    _stations_limits_map: typing.Dict[str, int] = dataclasses.field(init=False, repr=False)
+
+    def __post_init__(self):
+        days_off_dates = set()
+        for day_off in self.days_off or []:
+            try:
+                days_off_dates.add(datetime.datetime.strptime(day_off, "%d.%m.%Y").date())
+            except ValueError:
+                print(f"ERROR! Invalid day off {day_off} of doctor {self.name}, expected DD.MM.YYYY.")
+        self._days_off_dates = frozenset(days_off_dates)
+        self._skip_stations_set = frozenset(self.skip_stations or [])
+        self._stations_limits_map = dict(self.stations_limits or {})
 
     @property
     def folder_path(self):
+        return self.get_folder_path(_current_date())
+
+    def get_folder_path(self, date: datetime.date):
         _config = config.get()
-        return os.path.join(_config['output_path'], self.folder_name, _current_date().strftime("%d.%m.%Y"))
+        return os.path.join(_config['output_path'], self.folder_name, date.strftime("%d.%m.%Y"))
+
+    def get_holters(self, date: datetime.date):
+        return [holter.path for holter in self.get_holter_files(date)]
+
+    def get_holter_files(self, date: datetime.date) -> typing.List[scan.HolterFile]:
+        return scan.list_holters(self.get_folder_path(date))
 
     def get_today_holters(self):
-        if not os.path.exists(self.folder_path):
-            return []
-        return _get_holters_in_folder(self.folder_path)
+        return self.get_holters(_current_date())
 
-    def can_take_holter(self, holter_name):
+    def can_take_holter(self, holter_name, date, holters_count, stations_count):
         if not self.is_working:
             return False
 
-        if self.days_off and _current_date().strftime("%d.%m.%Y") in self.days_off:
+        if date in self._days_off_dates:
             return False
 
-        if self.skip_stations and holter_name[:2] in self.skip_stations:
+        holter_station = _get_station(holter_name)
+        if holter_station in self._skip_stations_set:
             return False
 
-        today_holters = self.get_today_holters()
-        if self.limit != -1 and len(today_holters) >= self.limit:
+        if self.limit != -1 and holters_count >= self.limit:
             return False
 
-        holter_station = holter_name[:2]
-        if self.stations_limits and holter_name in self.stations_limits:
-            station_count = sum([1 for h in today_holters if h[:2] == holter_station])
-            if station_count >= self.stations_limits[holter_name]:
-                return False
+        station_limit = self._stations_limits_map.get(holter_station)
+        if station_limit is not None and stations_count[holter_station] >= station_limit:
+            return False
 
         return True
 
 
-def _move_holter(holter_path: str, target_folder: str, operation_name: str):
-    if not os.path.exists(target_folder):
-        os.makedirs(target_folder)
-    target_path = os.path.join(target_folder, os.path.basename(holter_path))
-    print(operation_name, 'holter', holter_path, 'to', target_path)
-    try:
-        shutil.move(holter_path, target_path)
-    except Exception as e:
-        print(f"ERROR! Failed to move holter {holter_path} to {target_path}. Error: {e}")
+class DoctorsLoad:
+    """ In-memory holter counters of the doctors for one distribution pass.
+
+    Each doctor's folder is listed once when the pass starts; after that the
+    counters are updated on every assignment instead of re-listing folders.
+    """
+
+    def __init__(self, doctors: typing.List[Doctor], date: typing.Optional[datetime.date] = None):
+        self.doctors = doctors
+        self.date = date or _current_date()
+        self.holters_count = {}
+        self.stations_count = {}
+        # Weight of doctors without limit, used by get_load
+        self.unlimited_weight = max((doctor.limit for doctor in doctors if doctor.limit > 0), default=1)
+        for doctor in doctors:
+            holters = doctor.get_holter_files(self.date)
+            self.holters_count[doctor.folder_name] = len(holters)
+            self.stations_count[doctor.folder_name] = collections.Counter(holter.station for holter in holters)
+
+    def can_take_holter(self, doctor: Doctor, holter_name: str) -> bool:
+        return doctor.can_take_holter(
+            holter_name,
+            self.date,
+            self.holters_count[doctor.folder_name],
+            self.stations_count[doctor.folder_name],
+        )
+
+    def is_available(self, doctor: Doctor) -> bool:
+        """ Return False if the doctor cannot take any more holters this day. """
+        if not doctor.is_working or self.date in doctor._days_off_dates:
+            return False
+        return doctor.limit == -1 or self.holters_count[doctor.folder_name] < doctor.limit
+
+    def get_load(self, doctor: Doctor, weighted: bool = False) -> float:
+        """ Return doctor's holters count, or its share of the doctor's limit if weighted.
+
+        Doctors without limit are weighted as doctors with the biggest limit.
+        """
+        holters_count = self.holters_count[doctor.folder_name]
+        if not weighted:
+            return holters_count
+        weight = doctor.limit if doctor.limit > 0 else self.unlimited_weight
+        return holters_count / weight
+
+    def assign(
+        self, holter_names: typing.List[str], rng: random.Random, weighted: bool = False
+    ) -> typing.List[typing.Optional[Doctor]]:
+        """ Select doctor for every holter, None if no doctor can take it.
+
+        Doctors are kept in a heap by load (random tie-break), so the least loaded
+        doctor that can take the holter is found in O(log N) for most holters.
+        """
+        heap = [
+            (self.get_load(doctor, weighted), rng.random(), i)
+            for i, doctor in enumerate(self.doctors) if self.is_available(doctor)
+        ]
+        heapq.heapify(heap)
+        selected_doctors = []
+        for holter_name in holter_names:
+            skipped = []
+            doctor = None
+            while heap:
+                entry = heapq.heappop(heap)
+                candidate = self.doctors[entry[2]]
+                if self.can_take_holter(candidate, holter_name):
+                    doctor = candidate
+                    self.add_holter(doctor, holter_name)
+                    if self.is_available(doctor):
+                        heapq.heappush(heap, (self.get_load(doctor, weighted), rng.random(), entry[2]))
+                    break
+                # Doctor cannot take holters of this station, but can take others
+                skipped.append(entry)
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+            selected_doctors.append(doctor)
+        return selected_doctors
+
+    def add_holter(self, doctor: Doctor, holter_name: str):
+        self.holters_count[doctor.folder_name] += 1
+        self.stations_count[doctor.folder_name][_get_station(holter_name)] += 1
+
+
+def get_input_paths() -> typing.List[str]:
+    """ Return input_path and extra_input_paths (one per clinic) from the config. """
+    _config = config.get()
+    input_paths = [_config["input_path"]]
+    for input_path in _config.get("extra_input_paths") or []:
+        if input_path not in input_paths:
+            input_paths.append(input_path)
+    return input_paths
+
+
+def get_input_holter_files() -> typing.List[scan.HolterFile]:
+    return [holter for input_path in get_input_paths() for holter in scan.list_holters(input_path)]
+
+
+def get_input_holters() -> typing.List[str]:
+    return [holter.path for holter in get_input_holter_files()]
+
+
+def sort_holters(holters: typing.Iterable[str]) -> typing.List[str]:
+    """ Return holter paths in the order they are distributed.
+
+    Sorted by name, so the result does not depend on the order of files in the
+    folders and holters of different input folders are mixed in a batch.
+    """
+    return sorted(holters, key=lambda holter: (os.path.basename(holter), holter))
+
+
+def get_doctors() -> typing.List[Doctor]:
+    """ Return doctors from the config, they are re-created only when config changes. """
+    return config.compiled("doctors", lambda _config: [Doctor(**doctor) for doctor in _config["doctors"]])
+
+
+@dataclasses.dataclass
+class PassResult:
+    moves: mover.MoveStats = dataclasses.field(default_factory=mover.MoveStats)
+    duration: float = 0.0
+    # Holters found in the input folder
+    waiting: int = 0
+    # Stable holters left for the next pass because of max_batch
+    backlog: int = 0
+    # Pass was skipped because another distributor is running
+    skipped: bool = False
+    # Input folders which were not scanned in time, their holters wait for the next pass
+    unscanned: typing.List[str] = dataclasses.field(default_factory=list)
+    # Error which stopped the pass
+    error: typing.Optional[str] = None
+
+    def as_dict(self) -> dict:
+        data = dataclasses.asdict(self)
+        data["moves"] = self.moves.as_dict()
+        return data
+
+
+last_pass = PassResult()
+# Input folders with their holters which are possibly still being written
+input_sources = ingest.InputSources(quiet_seconds=10)
+
 
+def distribute_holters() -> PassResult:
+    """ Make one distribution pass, unless another thread or process is making it now. """
+    global last_pass
+    start = time.perf_counter()
+    with locks.FileLock(config.get().get("lock_path", "distributor.lock")) as acquired:
+        if not acquired:
+            print("Another distributor is running, skipping the pass.")
+            result = PassResult(skipped=True)
+        else:
+            # Moves left unfinished by a crash, or by a failed pass of this or another process
+            _recover_journal()
+            result = _distribute_holters()
+    result.duration = time.perf_counter() - start
+    last_pass = result
+    return result
 
-def give_holter_to_doctor(holter_path: str, doctor: Doctor):
-    _move_holter(holter_path, doctor.folder_path, 'Moving')
 
+def _recover_journal():
+    moved = journal.recover()
+    index.add_holters([(entry.doctor, entry.date, entry.target_path) for entry in moved if entry.doctor])
+    if moved:
+        print(f"Recovered {len(moved)} holters moved by the interrupted pass.")
 
-def reject_holter(holter_path: str):
-    _move_holter(holter_path, config.get()['rejected_path'], 'Rejecting')
+
+@dataclasses.dataclass
+class Assignment:
+    holter_path: str
+    # Doctor who gets the holter, None if it is a duplicate or no doctor can take it
+    doctor: typing.Optional[Doctor] = None
+    is_duplicate: bool = False
+
+    def as_dict(self) -> dict:
+        return {
+            "holter": os.path.basename(self.holter_path),
+            "doctor": self.doctor.folder_name if self.doctor else None,
+            "is_duplicate": self.is_duplicate,
+        }
 
 
-def distribute_holters():
+def plan_distribution(
+    holters: typing.List[str], doctors_load: typing.Optional[DoctorsLoad] = None
+) -> typing.List[Assignment]:
+    """ Decide what to do with every holter, without moving anything. """
     _config = config.get()
-    doctors = [Doctor(**doctor) for doctor in _config["doctors"]]
-    holters = _get_holters_in_folder(_config["input_path"])
-    existing_holters = set(
-        os.path.basename(h).lower() for h in _get_holters_in_folder(_config["output_path"], recursive=True)
+    if doctors_load is None:
+        doctors_load = DoctorsLoad(get_doctors())
+
+    with metrics.DISTRIBUTION_PHASE_SECONDS.time(phase="duplicate_check"):
+        assignments = []
+        planned_names = set()
+        for holter in holters:
+            holter_name = os.path.basename(holter)
+            # If holter already exists in the output folder, it will be rejected
+            is_duplicate = holter_name.lower() in planned_names or index.contains(holter_name)
+            planned_names.add(holter_name.lower())
+            assignments.append(Assignment(holter, is_duplicate=is_duplicate))
+
+    with metrics.DISTRIBUTION_PHASE_SECONDS.time(phase="rule_evaluation"):
+        to_assign = [assignment for assignment in assignments if not assignment.is_duplicate]
+        doctors = doctors_load.assign(
+            [os.path.basename(assignment.holter_path) for assignment in to_assign],
+            rng=random.Random(_config.get("assignment_seed")),
+            weighted=_config.get("balance_by_limit", False),
+        )
+        for assignment, doctor in zip(to_assign, doctors):
+            assignment.doctor = doctor
+    return assignments
+
+
+def _distribute_holters() -> PassResult:
+    _config = config.get()
+    with metrics.DISTRIBUTION_PHASE_SECONDS.time(phase="doctors_scan"):
+        doctors_load = DoctorsLoad(get_doctors())
+    with metrics.DISTRIBUTION_PHASE_SECONDS.time(phase="input_scan"):
+        input_sources.quiet_seconds = _config.get("stable_seconds", 10)
+        # Input folders are always listed anew, the memo would offer holters moved by the previous pass
+        scan_result = input_sources.scan(
+            get_input_paths(), lambda input_path: list(scan.iter_holters(input_path)),
+            timeout=_config.get("scan_timeout", 10),
+        )
+        for input_path in scan_result.unscanned:
+            print(f"WARNING! Input folder {input_path} is still being scanned, its holters wait for the next pass.")
+        holters = sort_holters(scan_result.stable)
+    max_batch = _config.get("max_batch", 100)
+    backlog = holters[max_batch:]
+    holters = holters[:max_batch]
+
+    # Plan the whole pass first, so the moves can be made in a batch
+    moves = []
+    doctors_by_move = {}
+    for assignment in plan_distribution(holters, doctors_load):
+        if assignment.is_duplicate:
+            moves.append(mover.Move(assignment.holter_path, _config['rejected_path'], 'Rejecting'))
+        elif assignment.doctor is None:
+            print(f"ERROR! No doctor can take holter {assignment.holter_path}. Please update the config file.")
+        else:
+            move = mover.Move(assignment.holter_path, assignment.doctor.get_folder_path(doctors_load.date))
+            moves.append(move)
+            doctors_by_move[move] = assignment.doctor
+
+    with metrics.DISTRIBUTION_PHASE_SECONDS.time(phase="moves"):
+        done, stats = _make_moves(moves, doctors_by_move, doctors_load.date)
+    metrics.DISTRIBUTION_PASSES.inc()
+    metrics.HOLTERS_MOVED.inc(stats.renamed, method="rename")
+    metrics.HOLTERS_MOVED.inc(stats.copied, method="copy")
+    metrics.HOLTERS_MOVED.inc(stats.failed, method="failed")
+    metrics.HOLTERS_MOVED_BYTES.inc(stats.bytes)
+    if moves:
+        print(
+            f"Moved {stats.files} holters ({stats.renamed} renamed, {stats.copied} copied, {stats.failed} failed) "
+            f"in {stats.duration:.2f}s: {stats.files_per_second:.1f} files/s, {stats.megabytes_per_second:.1f} MB/s"
+        )
+    return PassResult(
+        moves=stats, waiting=len(scan_result.holters), backlog=len(backlog), unscanned=scan_result.unscanned
     )
-    for holter in holters:
-        holter_name = os.path.basename(holter)
-        # If holter already exists in the output folder, move it to rejected folder
-        if holter_name.lower() in existing_holters:
-            reject_holter(holter)
-            continue
-
-        # Select doctor who can take this holter
-        acceptable_doctors = [doctor for doctor in doctors if doctor.can_take_holter(holter_name)]
-        if not acceptable_doctors:
-            print(f"ERROR! No doctor can take holter {holter}. Please update the config file.")
-            continue
-
-        # Randomly select doctor between doctors with minimum holters
-        min_holters_count = min([len(doctor.get_today_holters()) for doctor in acceptable_doctors])
-        doctors_with_min_holters = [
-            doctor for doctor in acceptable_doctors
-            if len(doctor.get_today_holters()) == min_holters_count
-        ]
-        doctor = random.choice(doctors_with_min_holters)
 
-        # Give the holter to the selected doctor
-        give_holter_to_doctor(holter, doctor)
 
+def _make_moves(
+    moves: typing.List[mover.Move], doctors_by_move: typing.Dict[mover.Move, Doctor], date: datetime.date
+) -> typing.Tuple[typing.List[mover.Move], mover.MoveStats]:
+    """ Make moves and index them, writing them ahead to the journal. """
+    if not moves:
+        return mover.move_batch(moves)
+    with journal.Journal() as moves_journal:
+        entries = moves_journal.plan([
+            (move.source_path, move.target_folder, doctors_by_move[move].folder_name, date)
+            if move in doctors_by_move else (move.source_path, move.target_folder, None, None)
+            for move in moves
+        ])
+        done, stats = mover.move_batch(moves)
+        scan.invalidate({os.path.dirname(move.source_path) for move in moves} | {move.target_folder for move in moves})
+        index.add_holters([
+            (doctors_by_move[move].folder_name, date, move.target_path)
+            for move in done if move in doctors_by_move
+        ])
+        # Files are still in the page cache, parse their headers before anybody opens the daily page
+        holter.prefetch_headers([move.target_path for move in done if move in doctors_by_move])
+        done_moves = set(done)
+        moves_journal.finish(
+            [entry for move, entry in zip(moves, entries) if move in done_moves],
+            [entry for move, entry in zip(moves, entries) if move not in done_moves],
+        )
+    return done, stats
+
+
+class PassScheduler:
+    """ Decides when the next distribution pass should run.
+
+    Passes go back-to-back while there is a backlog, follow the holters that are
+    still being written, and back off exponentially while the input folder is empty.
+    """
+
+    def __init__(self):
+        self._idle_delay = None
+
+    def get_next_delay(self, result: PassResult, max_delay: float) -> float:
+        poll_interval = config.get().get("poll_interval", 5)
+        if result.backlog:
+            self._idle_delay = None
+            return 0
+        release_delay = input_sources.get_next_release_delay()
+        if release_delay is not None:
+            self._idle_delay = None
+            return min(release_delay, max_delay)
+        if result.waiting or result.skipped or result.unscanned:
+            self._idle_delay = None
+            return min(poll_interval, max_delay)
+        self._idle_delay = min(self._idle_delay * 2 if self._idle_delay else poll_interval, max_delay)
+        return self._idle_delay
+
+
+def get_input_backlog() -> typing.Tuple[int, typing.Optional[float]]:
+    """ Return how many holters wait in the input folders and age (seconds) of the oldest one. """
+    holters = get_input_holter_files()
+    oldest_mtime = min((holter.mtime for holter in holters), default=None)
+    return len(holters), (time.time() - oldest_mtime if oldest_mtime is not None else None)
+
+
+def _get_daemon_path(suffix: str) -> str:
+    """ Return path of the daemon's file next to the distributor lock, e.g. distributor.status.json """
+    return os.path.splitext(config.get().get("lock_path", "distributor.lock"))[0] + suffix
+
+
+def get_daemon_lock() -> locks.FileLock:
+    """ Return lock which the distributor daemon holds while it is running. """
+    return locks.FileLock(_get_daemon_path(".daemon.lock"))
+
+
+def is_paused() -> bool:
+    return os.path.exists(_get_daemon_path(".paused"))
+
+
+def set_paused(paused: bool):
+    """ Pause or resume distribution passes of the daemon, which may run in another process. """
+    path = _get_daemon_path(".paused")
+    if paused:
+        open(path, "a").close()
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def read_status() -> typing.Optional[dict]:
+    """ Return status written by the distributor daemon after its last pass, None if there is none. """
+    try:
+        with open(_get_daemon_path(".status.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_status(status: dict):
+    path = _get_daemon_path(".status.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(status, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def run_forever():
+    """ Make distribution passes until the process is stopped, as the distributor daemon.
+
+    The daemon holds its own lock, so only one daemon runs, and after every pass
+    writes its status for the web workers, which run in other processes. Failed
+    pass is logged and repeated after poll_interval.
+    """
+    global last_pass
+    daemon_lock = get_daemon_lock()
+    for _ in range(5):
+        if daemon_lock.acquire():
+            break
+        # Web worker may be checking the lock right now
+        time.sleep(0.2)
+    else:
+        print("Distributor daemon is already running.")
+        sys.exit(1)
 
-if __name__ == "__main__":
     print("Distributing holters... Press Ctrl+C to stop.")
-    while True:
-        distribute_holters()
-        time.sleep(10)
+    input_watcher = watcher.create(get_input_paths())
+    pass_scheduler = PassScheduler()
+    try:
+        while True:
+            max_delay = watcher.get_interval(input_watcher)
+            paused = is_paused()
+            if paused:
+                delay = min(config.get().get("poll_interval", 5), max_delay)
+            else:
+                try:
+                    result = distribute_holters()
+                    delay = pass_scheduler.get_next_delay(result, max_delay)
+                except Exception as e:
+                    print(f"ERROR! Distribution pass failed: {e!r}")
+                    traceback.print_exc()
+                    last_pass = PassResult(error=repr(e))
+                    delay = min(config.get().get("poll_interval", 5), max_delay)
+            now = datetime.datetime.now().astimezone()
+            _write_status({
+                "pid": os.getpid(),
+                "paused": paused,
+                "updated_at": now.isoformat(),
+                "next_run_time": (now + datetime.timedelta(seconds=delay)).isoformat(),
+                "last_pass": {**last_pass.as_dict(), "input": input_sources.get_stats()},
+                "prefetch": holter.get_prefetch_stats(),
+                # Web workers serve them on /metrics, as they do not make the passes themselves
+                "metrics": metrics.render(metrics.DISTRIBUTOR_METRICS),
+            })
+            if delay:
+                input_watcher.wait(delay)
+    finally:
+        holter.stop_prefetch(timeout=5)
+        daemon_lock.release()
+
+
+if __name__ == "__main__":
+    if "--dry-run" in sys.argv:
+        for assignment in plan_distribution(sort_holters(get_input_holters())):
+            print(assignment.as_dict())
+        sys.exit()
+
+    run_forever()
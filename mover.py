@@ -0,0 +1,117 @@
+""" Moving holters in batches.
+
+Moves are grouped by the target folder, so each folder is created once. A holter is
+renamed when source and target are on the same device, otherwise it is copied to a
+temporary file, synced to disk and renamed, so a partial copy never has the holter name.
+"""
+import collections
+import dataclasses
+import errno
+import os
+import shutil
+import time
+import typing
+
+
+@dataclasses.dataclass(frozen=True)
+class Move:
+    source_path: str
+    target_folder: str
+    operation_name: str = 'Moving'
+
+    @property
+    def target_path(self):
+        return os.path.join(self.target_folder, os.path.basename(self.source_path))
+
+
+@dataclasses.dataclass
+class MoveStats:
+    files: int = 0
+    renamed: int = 0
+    copied: int = 0
+    failed: int = 0
+    bytes: int = 0
+    copied_bytes: int = 0
+    copy_duration: float = 0.0
+    duration: float = 0.0
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.duration if self.duration else 0.0
+
+    @property
+    def megabytes_per_second(self) -> float:
+        return self.bytes / 1024 / 1024 / self.duration if self.duration else 0.0
+
+    def as_dict(self) -> dict:
+        data = dataclasses.asdict(self)
+        data['files_per_second'] = round(self.files_per_second, 2)
+        data['megabytes_per_second'] = round(self.megabytes_per_second, 2)
+        return data
+
+
+def _copy(source_path: str, target_path: str):
+    """ Copy file to the temporary name, sync it and rename, then remove the source. """
+    temp_path = target_path + '.part'
+    try:
+        shutil.copyfile(source_path, temp_path)
+        shutil.copystat(source_path, temp_path)
+        with open(temp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(temp_path, target_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.remove(source_path)
+
+
+def _move(move: Move, target_device: int, stats: MoveStats):
+    source_stat = os.stat(move.source_path)
+    if source_stat.st_dev == target_device:
+        try:
+            os.rename(move.source_path, move.target_path)
+            stats.renamed += 1
+            stats.bytes += source_stat.st_size
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    copy_start = time.monotonic()
+    _copy(move.source_path, move.target_path)
+    stats.copy_duration += time.monotonic() - copy_start
+    stats.copied += 1
+    stats.copied_bytes += source_stat.st_size
+    stats.bytes += source_stat.st_size
+
+
+def move_batch(moves: typing.List[Move]) -> typing.Tuple[typing.List[Move], MoveStats]:
+    """ Move holters, return moves that succeeded and statistics of the batch. """
+    start = time.monotonic()
+    stats = MoveStats()
+    done = []
+    moves_by_folder = collections.defaultdict(list)
+    for move in moves:
+        moves_by_folder[move.target_folder].append(move)
+
+    for target_folder, folder_moves in moves_by_folder.items():
+        try:
+            os.makedirs(target_folder, exist_ok=True)
+            target_device = os.stat(target_folder).st_dev
+        except OSError as e:
+            print(f"ERROR! Failed to create folder {target_folder}. Error: {e}")
+            stats.failed += len(folder_moves)
+            continue
+        for move in folder_moves:
+            print(move.operation_name, 'holter', move.source_path, 'to', move.target_path)
+            try:
+                _move(move, target_device, stats)
+            except Exception as e:
+                print(f"ERROR! Failed to move holter {move.source_path} to {move.target_path}. Error: {e}")
+                stats.failed += 1
+                continue
+            stats.files += 1
+            done.append(move)
+
+    stats.duration = time.monotonic() - start
+    return done, stats
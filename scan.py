@@ -0,0 +1,91 @@
+""" Listing holters in the folders.
+
+Folders are read with os.scandir and every holter is returned as a compact
+HolterFile record, so its size and mtime are taken once and reused by the
+callers instead of calling os.stat on the path again.
+
+list_holters keeps listings for a few seconds (scan_cache_seconds), so the same
+folders are not read again within one request or distribution pass. Folders
+changed by the distributor are dropped from the memo with invalidate.
+"""
+import os
+import threading
+import time
+import typing
+
+import config
+
+
+class HolterFile(typing.NamedTuple):
+    path: str
+    name: str
+    size: int
+    mtime: float
+
+    @property
+    def station(self) -> str:
+        return self.name[:2]
+
+
+_memo: typing.Dict[typing.Tuple[str, bool], typing.Tuple[float, typing.List[HolterFile]]] = {}
+_memo_lock = threading.Lock()
+
+
+def is_holter(file_name: str) -> bool:
+    return file_name.lower().endswith(".zhr")
+
+
+def iter_holters(folder_path: str, recursive: bool = False) -> typing.Iterator[HolterFile]:
+    """ Yield holters of the folder, and of its subfolders if recursive. """
+    with os.scandir(folder_path) as entries:
+        subfolders = []
+        for entry in entries:
+            if recursive and entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.path)
+                continue
+            if not is_holter(entry.name):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # file was moved away while listing the folder
+                continue
+            yield HolterFile(entry.path, entry.name, stat.st_size, stat.st_mtime)
+    for subfolder in subfolders:
+        try:
+            yield from iter_holters(subfolder, recursive=True)
+        except FileNotFoundError:
+            # folder was removed while listing its parent
+            continue
+
+
+def list_holters(folder_path: str, recursive: bool = False) -> typing.List[HolterFile]:
+    """ Return holters of the folder, listed at most scan_cache_seconds ago.
+
+    Missing folder has no holters.
+    """
+    max_age = config.get().get("scan_cache_seconds", 2)
+    key = (folder_path, recursive)
+    now = time.monotonic()
+    with _memo_lock:
+        cached = _memo.get(key)
+    if cached is not None and now - cached[0] <= max_age:
+        return cached[1]
+    try:
+        holters = list(iter_holters(folder_path, recursive=recursive))
+    except FileNotFoundError:
+        holters = []
+    with _memo_lock:
+        _memo[key] = (now, holters)
+        # Drop expired listings, so the memo does not grow with the days' folders
+        for expired_key in [k for k, (listed_at, _) in _memo.items() if now - listed_at > max_age]:
+            del _memo[expired_key]
+    return holters
+
+
+def invalidate(folder_paths: typing.Iterable[str]):
+    """ Forget listings of the folders, after holters were moved into or out of them. """
+    folder_paths = {os.path.normpath(folder_path) for folder_path in folder_paths}
+    with _memo_lock:
+        for key in [key for key in _memo if os.path.normpath(key[0]) in folder_paths]:
+            del _memo[key]
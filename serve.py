@@ -0,0 +1,56 @@
+""" Production entry point: the web app is served by several worker threads, and
+holters are distributed by the daemon (python move_holters.py) in its own process.
+
+Usage: python serve.py --host 0.0.0.0 --port 8000 --threads 8 --with-distributor
+
+Waitress is used when it is installed (pip install waitress), otherwise the
+threaded werkzeug server. `app` of this module can also be given to any WSGI
+server, e.g. gunicorn -w 4 serve:app, as the workers never start passes
+themselves; run the distributor daemon next to them.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+
+import web
+
+web.in_process_scheduler = False
+app = web.app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--threads", type=int, default=8, help="worker threads of waitress serving the requests")
+    parser.add_argument("--with-distributor", action="store_true", help="start the distributor daemon as well")
+    args = parser.parse_args()
+
+    # Exit normally on SIGTERM, so the distributor daemon is stopped together with the server
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    distributor = None
+    if args.with_distributor:
+        distributor = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "move_holters.py")]
+        )
+    try:
+        try:
+            import waitress
+        except ImportError:
+            waitress = None
+        if waitress is not None:
+            waitress.serve(app, host=args.host, port=args.port, threads=args.threads)
+        else:
+            from werkzeug.serving import run_simple
+            print("Waitress is not installed, serving with the threaded werkzeug server.")
+            run_simple(args.host, args.port, app, threaded=True)
+    finally:
+        if distributor is not None:
+            distributor.terminate()
+            distributor.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+""" Waiting for new holters in the input folders.
+
+InotifyWatcher wakes up as soon as a file is written or moved into any of the folders.
+On systems without inotify PollingWatcher is used, it just sleeps for the interval.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+import typing
+
+import config
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    is_event_driven = False
+
+    def __init__(self, folder_paths: typing.List[str]):
+        self.folder_paths = folder_paths
+
+    def wait(self, timeout: float) -> typing.List[str]:
+        """ Sleep for the timeout, return empty list as changes are unknown. """
+        time.sleep(timeout)
+        return []
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    is_event_driven = True
+
+    def __init__(self, folder_paths: typing.List[str]):
+        self.folder_paths = folder_paths
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Watch descriptor -> folder path
+        self._folders = {}
+        for folder_path in folder_paths:
+            watch_descriptor = libc.inotify_add_watch(
+                self._fd, os.fsencode(folder_path), IN_CLOSE_WRITE | IN_MOVED_TO
+            )
+            if watch_descriptor < 0:
+                os.close(self._fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder_path}")
+            self._folders[watch_descriptor] = folder_path
+
+    def wait(self, timeout: float) -> typing.List[str]:
+        """ Wait until holters are written or moved into the folders, return their paths.
+
+        Empty list means that the timeout has passed without new holters.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if not ready:
+                return []
+            holters = [
+                os.path.join(self._folders[watch_descriptor], file_name)
+                for watch_descriptor, file_name in self._read_events()
+                if watch_descriptor in self._folders and file_name.lower().endswith(".zhr")
+            ]
+            if holters:
+                return holters
+
+    def _read_events(self) -> typing.List[typing.Tuple[int, str]]:
+        """ Return (watch descriptor, file name) of the read events. """
+        buffer = os.read(self._fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            watch_descriptor, _, _, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+            if name:
+                events.append((watch_descriptor, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+def create(folder_paths: typing.List[str]):
+    """ Return inotify watcher for the folders, or polling watcher if inotify is unavailable. """
+    if config.get().get("watch_input", False):
+        try:
+            return InotifyWatcher(folder_paths)
+        except (OSError, AttributeError) as e:
+            print(f"WARNING! Cannot watch {', '.join(folder_paths)} with inotify, falling back to polling. Error: {e}")
+    return PollingWatcher(folder_paths)
+
+
+def get_interval(watcher=None) -> float:
+    """ Return the longest wait for new holters before scanning the input folder anyway.
+
+    Inotify does not see files written by other machines to a network share,
+    so the folder is still rescanned, but much less often than while polling.
+    """
+    _config = config.get()
+    if watcher is not None and watcher.is_event_driven:
+        return _config.get("rescan_interval", 300)
+    return _config.get("max_poll_interval", 60)
@@ -1,27 +1,32 @@
 import datetime
 import calendar
 import config
+import itertools
+import json
 import os
-import yaml
-from flask import Flask, render_template, jsonify, redirect, url_for, request, session, flash
-from apscheduler.schedulers.background import BackgroundScheduler
+import threading
+import urllib.parse
+from flask import Flask, Response, render_template, jsonify, redirect, url_for, request, session, flash
 
-import holter
-import move_holters
-from data import get_daily_metadata
+import index
+import metrics
+from data import get_daily_matrix, get_monthly_matrix, get_stats_version, sync_current_folders
 
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'  # Change this to a random secret key
-scheduler = BackgroundScheduler()
-
-# Load config including users
-with open("config.yaml", 'r') as file:
-    CONFIG = yaml.safe_load(file)
-
+# Distribution scheduler and the modules it needs are loaded on first use, so the
+# web worker starts and serves the first pages without waiting for them.
+_scheduler = None
+input_watcher = None
+pass_scheduler = None
+# False when passes are made by the distributor daemon (serve.py), scheduler controls then pause and resume it
+in_process_scheduler = True
 
 @app.before_request
 def check_config_access():
+    if request.endpoint == 'ready':
+        return None
     try:
         config.get()
     except Exception as e:
@@ -45,10 +50,7 @@ def require_auth(is_admin=False):
 
 
 def get_user(username):
-    for user in CONFIG.get('users', []):
-        if user['username'] == username:
-            return user
-    return None
+    return config.get_users().get(username)
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -58,9 +60,9 @@ def login():
         password = request.form['password']
 
         user = get_user(username)
-        if user and user['password'] == password:
+        if user and user.password == password:
             session['username'] = username
-            session['is_admin'] = user['is_admin']
+            session['is_admin'] = user.is_admin
             return redirect(url_for('home'))
         else:
             return render_template('login.html', error='Invalid username or password')
@@ -84,36 +86,43 @@ class Cell:
         return str(self.value)
 
 
-@app.route("/<int:year>/<int:month>/")
-@require_auth(is_admin=False)
-def monthly_stats(year, month):
-    # Daily stats for given month and year
-    daily_metadata = get_daily_metadata(year=year, month=month)
-
-    # Initialize dates as all possible days (integers) of the current month
-    num_days = calendar.monthrange(year, month)[1]
-    headers = ["Doctor \\ Date"] + list(range(1, num_days + 1)) + ["Total"]
-
+def _make_stats_table(first_header, total_header, headers, doctors, matrix, doctor_link, total_link):
+    """ Build rows of the stats table with totals, links are made by the doctor_link(doctor, column)
+    and total_link(column) callables, which should not call url_for for every cell. """
     data = []
-    summary_row = ["Daily total"] + [0] * num_days
-    for doctor, doctor_metadata in daily_metadata.items():
+    totals = [0] * len(headers)
+    for doctor, counts in zip(doctors, matrix):
         row = [doctor]
-        row_count = 0
-        for day in range(1, num_days + 1):
-            date_ = datetime.date(year, month, day)
-            count = doctor_metadata.get(date_, 0)
-            row_count += count
-            link = url_for('daily_doctor_stats', year=year, month=month, day=day, doctor=doctor)
-            row.append(Cell(count, link=link))
-            summary_row[day] += count
-        row.append(row_count)
+        for column, count in enumerate(counts):
+            row.append(Cell(count, link=doctor_link(doctor, headers[column])))
+            totals[column] += count
+        row.append(sum(counts))
         data.append(row)
-    summary_row = summary_row[:1] + [
-        Cell(value, link=url_for('daily_stats', year=year, month=month, day=day))
-        for day, value in zip(range(1, num_days + 1), summary_row[1:])
-    ]
-    summary_row.append(sum([cell.value for cell in summary_row[1:]]))
+    summary_row = [total_header] + [Cell(count, link=total_link(header)) for header, count in zip(headers, totals)]
+    summary_row.append(sum(totals))
     data.append(summary_row)
+    return [first_header] + list(headers) + ["Total"], data
+
+
+@app.route("/<int:year>/<int:month>/")
+@require_auth(is_admin=False)
+def monthly_stats(year, month):
+    # Daily stats for given month and year
+    with metrics.STATS_PHASE_SECONDS.time(view=request.endpoint, phase="metadata_scan"):
+        doctors, matrix = get_daily_matrix(year, month)
+
+    # Links of the days are the month link followed by /<day>/ and /<day>/<doctor>/
+    month_link = url_for('monthly_stats', year=year, month=month)
+    doctor_paths = {doctor: urllib.parse.quote(doctor, safe='') for doctor in doctors}
+    headers, data = _make_stats_table(
+        "Doctor \\ Date",
+        "Daily total",
+        range(1, calendar.monthrange(year, month)[1] + 1),
+        doctors,
+        matrix,
+        doctor_link=lambda doctor, day: f"{month_link}{day}/{doctor_paths[doctor]}/",
+        total_link=lambda day: f"{month_link}{day}/",
+    )
 
     previous_year = year - 1 if month == 1 else year
     previous_month = 12 if month == 1 else month - 1
@@ -128,32 +137,84 @@ def monthly_stats(year, month):
         name=f"Stats for {month:02d}/{year}",
         headers=headers,
         data=data,
-        previous_month_link=previous_month_link,
-        next_month_link=next_month_link,
+        previous_link=previous_month_link,
+        previous_link_name="Previous Month",
+        next_link=next_month_link,
+        next_link_name="Next Month",
+        up_link=url_for('yearly_stats', year=year),
+        up_link_name=f"Year {year}",
     )
 
 
-def _get_daily_data(year, month, day, doctor):
-    path = os.path.join(
-        config.get()["output_path"], doctor, '{:02d}.{:02d}.{}'.format(day, month, year)
+@app.route("/<int:year>/")
+@require_auth(is_admin=False)
+def yearly_stats(year):
+    # Monthly stats for given year
+    with metrics.STATS_PHASE_SECONDS.time(view=request.endpoint, phase="metadata_scan"):
+        doctors, matrix = get_monthly_matrix(year)
+
+    year_link = url_for('yearly_stats', year=year)
+    headers, data = _make_stats_table(
+        "Doctor \\ Month",
+        "Monthly total",
+        range(1, 13),
+        doctors,
+        matrix,
+        doctor_link=lambda doctor, month: f"{year_link}{month}/",
+        total_link=lambda month: f"{year_link}{month}/",
+    )
+    return render_template(
+        "stats.html",
+        name=f"Stats for {year}",
+        headers=headers,
+        data=data,
+        previous_link=url_for('yearly_stats', year=year - 1),
+        previous_link_name="Previous Year",
+        next_link=url_for('yearly_stats', year=year + 1),
+        next_link_name="Next Year",
     )
-    data = []
-    if os.path.exists(path):
-        file_names = holter.get_in_folder(path)
-        for file_name in file_names:
-            patient_data = holter.get_patient_data(file_name)
-            row = [
-                os.path.basename(file_name),
-                patient_data['name'],
-            ]
-            data.append(row)
-    return data
+
+
+def _get_daily_holters(year, month, day, doctors=None):
+    """ Return (doctor, file name) of the doctors' (all by default) holters of the day """
+    date_ = datetime.date(year, month, day)
+    with metrics.STATS_PHASE_SECONDS.time(view=request.endpoint, phase="metadata_scan"):
+        if doctors is None:
+            doctors = os.listdir(config.get()["output_path"])
+        # Manual changes of the current days' folders get to the index first
+        sync_current_folders(doctors)
+        return [
+            (doctor, holter_name)
+            for doctor in doctors
+            for holter_name in index.get_holter_names(doctor, date_)
+        ]
+
+
+def _add_patient_names(year, month, day, holters):
+    """ Return [doctor, file name, patient name] rows for the (doctor, file name) of the day """
+    date_ = datetime.date(year, month, day)
+    paths = [
+        os.path.join(config.get()["output_path"], doctor, date_.strftime("%d.%m.%Y"), holter_name)
+        for doctor, holter_name in holters
+    ]
+    import holter
+    with metrics.STATS_PHASE_SECONDS.time(view=request.endpoint, phase="header_parsing"):
+        patients_data = holter.get_patients_data(paths)
+    return [
+        [doctor, holter_name, patient_data['name']]
+        for (doctor, holter_name), patient_data in zip(holters, patients_data)
+    ]
+
+
+def _get_daily_data(year, month, day, doctors=None):
+    """ Return [doctor, file name, patient name] rows for the doctors' (all by default) holters of the day """
+    return _add_patient_names(year, month, day, _get_daily_holters(year, month, day, doctors))
 
 
 @app.route("/<int:year>/<int:month>/<int:day>/<string:doctor>/")
 @require_auth(is_admin=False)
 def daily_doctor_stats(year, month, day, doctor):
-    data = _get_daily_data(year, month, day, doctor)
+    data = [row[1:] for row in _get_daily_data(year, month, day, [doctor])]
     headers = ["File Name", "Name"]
     name = f"Stats for {doctor} on {day:02d}.{month:02d}.{year}"
     return render_template(
@@ -166,12 +227,7 @@ def daily_doctor_stats(year, month, day, doctor):
 @app.route("/<int:year>/<int:month>/<int:day>/")
 @require_auth(is_admin=False)
 def daily_stats(year, month, day):
-    doctors = get_daily_metadata(year=year, month=month).keys()
-    data = []
-    for doctor in doctors:
-        doctor_data = _get_daily_data(year, month, day, doctor)
-        doctor_data = [[doctor] + row for row in doctor_data]
-        data += doctor_data
+    data = _get_daily_data(year, month, day)
     headers = ["Doctor", "File Name", "Name"]
     name = f"Stats for {day:02d}.{month:02d}.{year}"
     return render_template(
@@ -188,6 +244,99 @@ def stats():
     now = datetime.datetime.now()
     return redirect(url_for('monthly_stats', year=now.year, month=now.month))
 
+# ------ API ------
+
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+
+def _conditional_json(year, month, build):
+    """ Return 304 if the client has the current version of the month's stats, otherwise JSON of build(). """
+    # Synced before the version is taken, so the ETag and the body describe the same folders
+    sync_current_folders()
+    etag = get_stats_version(year, month)
+    response = Response(status=304) if request.if_none_match.contains(etag) else jsonify(build())
+    response.set_etag(etag)
+    return response
+
+
+def _get_page():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', API_PAGE_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+    return page, per_page
+
+
+def _paginate_daily_data(year, month, day, doctors=None):
+    """ Return page of the day's holters, only holters of the page are parsed. """
+    page, per_page = _get_page()
+    holters = _get_daily_holters(year, month, day, doctors)
+    rows = _add_patient_names(year, month, day, holters[(page - 1) * per_page:page * per_page])
+    return {
+        'date': datetime.date(year, month, day).isoformat(),
+        'page': page,
+        'per_page': per_page,
+        'total': len(holters),
+        'pages': (len(holters) + per_page - 1) // per_page,
+        'items': [
+            {'doctor': doctor, 'file_name': holter_name, 'name': name}
+            for doctor, holter_name, name in rows
+        ],
+    }
+
+
+@app.route("/api/<int:year>/<int:month>/")
+@require_auth(is_admin=False)
+def api_monthly_stats(year, month):
+    def build():
+        with metrics.STATS_PHASE_SECONDS.time(view=request.endpoint, phase="metadata_scan"):
+            doctors, matrix = get_daily_matrix(year, month)
+        return {
+            'year': year,
+            'month': month,
+            'doctors': [
+                {'doctor': doctor, 'counts': counts, 'total': sum(counts)}
+                for doctor, counts in zip(doctors, matrix)
+            ],
+            'totals': [sum(day_counts) for day_counts in zip(*matrix)],
+        }
+    return _conditional_json(year, month, build)
+
+
+@app.route("/api/<int:year>/<int:month>/<int:day>/")
+@require_auth(is_admin=False)
+def api_daily_stats(year, month, day):
+    def build():
+        return _paginate_daily_data(year, month, day)
+    return _conditional_json(year, month, build)
+
+
+@app.route("/api/<int:year>/<int:month>/<int:day>/<string:doctor>/")
+@require_auth(is_admin=False)
+def api_daily_doctor_stats(year, month, day, doctor):
+    def build():
+        return {'doctor': doctor, **_paginate_daily_data(year, month, day, [doctor])}
+    return _conditional_json(year, month, build)
+
+# ------ Export ------
+
+@app.route("/export.csv")
+@require_auth(is_admin=False)
+def export_csv():
+    """ Stream holters with the patients' data from ?start= to ?end= (YYYY-MM-DD), optionally for ?doctor= """
+    try:
+        start = datetime.date.fromisoformat(request.args['start'])
+        end = datetime.date.fromisoformat(request.args['end'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'start and end dates are required in YYYY-MM-DD format'}), 400
+    import export
+    doctor = request.args.get('doctor')
+    file_name = f"holters_{start.isoformat()}_{end.isoformat()}.csv"
+    return Response(
+        itertools.chain(["\ufeff"], export.iter_csv(start, end, doctor=doctor)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'},
+    )
+
 # ------ Config ------
 
 @require_auth(is_admin=False)
@@ -211,6 +360,31 @@ def get_doctor_by_name(name):
     return None
 
 
+# Settings which are written to config.yaml only if they are set, with their comments
+OPTIONAL_SETTINGS = [
+    ("extra_input_paths", "додаткові папки з холтерами (по одній на клініку), кожна сканується окремо"),
+    ("scan_cache_seconds", "скільки секунд памʼятати вміст папок, щоб не читати їх повторно в межах одного запиту"),
+    ("scan_timeout", "скільки секунд чекати сканування папки з холтерами, повільна папка не затримує інші"),
+    ("startup_delay", "через скільки секунд після запуску робити перший розподіл, щоб не заважати першим запитам"),
+    ("index_path", "файл індексу розподілених холтерів (SQLite)"),
+    ("patient_cache_path", "файл кешу даних пацієнтів (SQLite), щоб не читати холтери повторно"),
+    ("patient_cache_size", "скільки записів кешу даних пацієнтів тримати в памʼяті"),
+    ("prefetch_queue_size", "скільки розподілених холтерів може чекати фонового читання даних пацієнта, 0 - не читати"),
+    ("prefetch_workers", "скільки потоків читають дані пацієнтів розподілених холтерів у фоні"),
+    ("patient_data_workers", "скільки холтерів читати паралельно для сторінок статистики"),
+    ("balance_by_limit", "розподіляти пропорційно до ліміту лікаря, а не порівну"),
+    ("assignment_seed", "зерно випадкового вибору лікаря, щоб розподіл можна було відтворити"),
+    ("max_batch", "скільки холтерів розподіляти за один прохід, решта - одразу наступним проходом"),
+    ("lock_path", "файл блокування, щоб холтери розподіляв лише один процес"),
+    ("journal_path", "журнал переміщень холтерів, щоб відновитись після збою і бачити історію розподілу"),
+    ("stable_seconds", "скільки секунд холтер не має змінюватись, щоб його можна було розподілити"),
+    ("watch_input", "реагувати на нові файли в input_path одразу (inotify), замість періодичної перевірки"),
+    ("poll_interval", "як часто (секунди) перевіряти input_path, поки в ній є холтери"),
+    ("max_poll_interval", "до скількох секунд збільшувати паузу між перевірками, поки input_path порожня"),
+    ("rescan_interval", "як часто (секунди) все одно перевіряти input_path, коли працює inotify"),
+]
+
+
 def format_yaml_config(config_data):
     """Format YAML config with proper indentation and spacing like example_config.yaml."""
     lines = []
@@ -220,6 +394,9 @@ def format_yaml_config(config_data):
     lines.append(f'output_path: "{config_data["output_path"]}"  # тут будуть створюватися папки лікарів')
     lines.append(f'rejected_path: "{config_data["rejected_path"]}"  # тут будуть файли дуплікати (імʼя яких є вже в папці output_path)')
     lines.append(f'evening_hours: {config_data["evening_hours"]} # години до кінця дня, після яких холтери будуть переноситись на наступний день')
+    for key, comment in OPTIONAL_SETTINGS:
+        if key in config_data:
+            lines.append(f'{key}: {json.dumps(config_data[key], ensure_ascii=False)}  # {comment}')
     lines.append('')
     lines.append('doctors:')
 
@@ -266,39 +443,32 @@ def format_yaml_config(config_data):
     return '\n'.join(lines) + '\n'
 
 
-def update_doctor_config(doctor_name, updated_data):
-    """Update doctor configuration in config.yaml file."""
-    try:
-        # Read current config from file
-        with open("config.yaml", 'r', encoding='utf-8') as file:
-            current_config = yaml.safe_load(file)
+def update_doctor_config(doctor_name, updated_data, expected_revision=None):
+    """Update doctor configuration in config.yaml file.
 
+    Raises config.ConflictError if the file was changed since expected_revision was read.
+    """
+    def update_doctor(current_config):
         # Find and update the doctor
-        doctor_found = False
-        for i, doctor in enumerate(current_config.get('doctors', [])):
+        for doctor in current_config.get('doctors', []):
             if doctor['name'] == doctor_name:
                 # Update the doctor with new data, preserving name and folder_name
-                current_config['doctors'][i].update({
+                doctor.update({
                     'limit': updated_data['limit'],
                     'skip_stations': updated_data['skip_stations'],
                     'stations_limits': updated_data['stations_limits'],
                     'is_working': updated_data['is_working'],
                     'days_off': updated_data['days_off']
                 })
-                doctor_found = True
-                break
-
-        if not doctor_found:
-            raise ValueError(f"Doctor '{doctor_name}' not found in configuration")
-
-        # Write updated config back to file with proper formatting
-        formatted_yaml = format_yaml_config(current_config)
-        with open("config.yaml", 'w', encoding='utf-8') as file:
-            file.write(formatted_yaml)
-
-        config.reset()
+                return
+        raise ValueError(f"Doctor '{doctor_name}' not found in configuration")
 
+    try:
+        # Written with proper formatting to a temporary file which replaces config.yaml
+        config.update(update_doctor, format_yaml_config, expected_revision=expected_revision)
         return True
+    except config.ConflictError:
+        raise
     except Exception as e:
         print(f"Error updating doctor config: {e}")
         return False
@@ -371,8 +541,8 @@ def edit_doctor(doctor_name):
                 'days_off': days_off if days_off else None
             }
 
-            # Update configuration
-            if update_doctor_config(doctor_name, updated_data):
+            # Update configuration, unless someone else saved it since the form was opened
+            if update_doctor_config(doctor_name, updated_data, request.form.get('config_revision') or None):
                 # Get the updated doctor data and convert dates for display
                 updated_doctor = get_doctor_by_name(doctor_name)
                 doctor_copy = updated_doctor.copy()
@@ -390,20 +560,30 @@ def edit_doctor(doctor_name):
 
                 return render_template('edit_doctor.html',
                                      doctor=doctor_copy,
+                                     config_revision=config.revision(),
                                      success="Doctor configuration updated successfully!")
             else:
                 return render_template('edit_doctor.html',
                                      doctor=doctor,
+                                     config_revision=config.revision(),
                                      error="Failed to update doctor configuration.")
 
+        except config.ConflictError as e:
+            # Show the form again with the saved configuration, to be reviewed and saved again
+            error = str(e)
+            doctor = get_doctor_by_name(doctor_name) or doctor
         except ValueError as e:
             return render_template('edit_doctor.html',
                                  doctor=doctor,
+                                 config_revision=config.revision(),
                                  error=str(e))
         except Exception as e:
             return render_template('edit_doctor.html',
                                  doctor=doctor,
+                                 config_revision=config.revision(),
                                  error=f"An unexpected error occurred: {str(e)}")
+    else:
+        error = None
 
     # GET request - show form
     # Convert days_off from DD.MM.YYYY to YYYY-MM-DD for HTML date inputs
@@ -420,37 +600,120 @@ def edit_doctor(doctor_name):
                 converted_days.append(day_off)
         doctor_copy['days_off'] = converted_days
 
-    return render_template('edit_doctor.html', doctor=doctor_copy)
+    return render_template('edit_doctor.html', doctor=doctor_copy, config_revision=config.revision(), error=error)
+
+
+# Held by the job instance which is making passes, other instances only ask it for one more pass
+_task_lock = threading.Lock()
+_wake_requested = threading.Event()
+
+
+def get_scheduler():
+    """ Return the background scheduler, APScheduler is imported only when it is needed. """
+    global _scheduler
+    if _scheduler is None:
+        from apscheduler.schedulers.background import BackgroundScheduler
+        _scheduler = BackgroundScheduler()
+    return _scheduler
 
 
 def _distribute_holters_task():
-    move_holters.distribute_holters()
+    import move_holters
+    import watcher
+    if not _task_lock.acquire(blocking=False):
+        _wake_requested.set()
+        return
+    try:
+        while True:
+            _wake_requested.clear()
+            result = move_holters.distribute_holters()
+            delay = pass_scheduler.get_next_delay(result, watcher.get_interval(input_watcher))
+            if delay > 0 and not _wake_requested.is_set():
+                break
+    finally:
+        _task_lock.release()
+    if _wake_requested.is_set():
+        delay = 0
+    _schedule_next_pass(delay)
+
+
+def _schedule_next_pass(delay: float):
+    job = get_scheduler().get_job("distribute-holters-task")
+    if job:
+        job.modify(next_run_time=datetime.datetime.now().astimezone() + datetime.timedelta(seconds=delay))
+
+
+def _add_distribution_job(delay: float = 0):
+    import watcher
+    # Passes reschedule themselves, the interval is only the longest wait between them.
+    # Second instance is allowed, so the running pass is asked to repeat instead of
+    # APScheduler skipping the run with a warning.
+    get_scheduler().add_job(
+        func=_distribute_holters_task,
+        trigger="interval",
+        seconds=watcher.get_interval(input_watcher),
+        id="distribute-holters-task",
+        replace_existing=True,
+        max_instances=2,
+        coalesce=True,
+        misfire_grace_time=None,
+        next_run_time=datetime.datetime.now().astimezone() + datetime.timedelta(seconds=delay),
+    )
 
 
-def _start_scheduler():
+def _watch_input():
+    """ Run the distribution job right away when new holters appear in the input folder. """
+    import watcher
+    while True:
+        if input_watcher.wait(watcher.get_interval(input_watcher)):
+            _schedule_next_pass(0)
+
+
+def _start_scheduler(delay: float = 0):
+    """ Start distribution passes, the first one after the delay (seconds). """
+    import move_holters
+    import watcher
+    global input_watcher, pass_scheduler
+    scheduler = get_scheduler()
     if not scheduler.running:
-        scheduler.add_job(
-            func=_distribute_holters_task,
-            trigger="interval",
-            seconds=5,
-            id="distribute-holters-task",
-            replace_existing=True,
-        )
+        input_watcher = watcher.create(move_holters.get_input_paths())
+        pass_scheduler = move_holters.PassScheduler()
+        _add_distribution_job(delay)
         scheduler.start()
         print("Scheduler started.")
+        if input_watcher.is_event_driven:
+            threading.Thread(target=_watch_input, name="input-watcher", daemon=True).start()
+            print("Watching input folder for new holters.")
+
+
+def _daemon_status():
+    import move_holters
+    status = move_holters.read_status() or {}
+    if not move_holters.get_daemon_lock().is_held():
+        state = "Distributor is not running ❌"
+    elif move_holters.is_paused():
+        state = "Distributor is paused ❌"
+    else:
+        state = "Distributor is running ✅"
+    return jsonify({
+        "status": state,
+        "last_pass": status.get("last_pass"),
+        "next_run_time": status.get("next_run_time"),
+        "prefetch": status.get("prefetch"),
+    })
 
 
 @app.route("/scheduler/start", methods=["POST"])
 @require_auth(is_admin=True)
 def scheduler_start():
-    if not scheduler.get_job("distribute-holters-task"):
-        scheduler.add_job(
-            func=_distribute_holters_task,
-            trigger="interval",
-            seconds=5,
-            id="distribute-holters-task",
-            replace_existing=True,
-        )
+    if not in_process_scheduler:
+        import move_holters
+        move_holters.set_paused(False)
+        return _daemon_status()
+    if not get_scheduler().running:
+        _start_scheduler()
+    elif not get_scheduler().get_job("distribute-holters-task"):
+        _add_distribution_job()
         print("Scheduler job added.")
     return jsonify({"status": "Job is running ✅"})
 
@@ -458,9 +721,13 @@ def scheduler_start():
 @app.route("/scheduler/stop", methods=["POST"])
 @require_auth(is_admin=True)
 def scheduler_stop():
-    job = scheduler.get_job("distribute-holters-task")
+    if not in_process_scheduler:
+        import move_holters
+        move_holters.set_paused(True)
+        return _daemon_status()
+    job = get_scheduler().get_job("distribute-holters-task")
     if job:
-        scheduler.remove_job("distribute-holters-task")
+        get_scheduler().remove_job("distribute-holters-task")
         print("Scheduler job removed.")
     return jsonify({"status": "Job is not running ❌"})
 
@@ -468,11 +735,111 @@ def scheduler_stop():
 @app.route("/scheduler/status", methods=["GET"])
 @require_auth(is_admin=True)
 def scheduler_status():
-    job = scheduler.get_job("distribute-holters-task")
-    if job:
-        return jsonify({"status": "Job is running ✅"})
+    if not in_process_scheduler:
+        return _daemon_status()
+    import holter
+    import move_holters
+    job = get_scheduler().get_job("distribute-holters-task")
+    last_pass = move_holters.last_pass.as_dict()
+    last_pass["input"] = move_holters.input_sources.get_stats()
+    next_run_time = job.next_run_time.isoformat() if job and job.next_run_time else None
+    return jsonify({
+        "status": "Job is running ✅" if job else "Job is not running ❌",
+        "last_pass": last_pass,
+        "next_run_time": next_run_time,
+        "prefetch": holter.get_prefetch_stats(),
+    })
+
+
+@app.route("/scheduler/plan", methods=["GET"])
+@require_auth(is_admin=True)
+def scheduler_plan():
+    """ Show how holters of the input folder would be distributed now, without moving them. """
+    import move_holters
+    holters = move_holters.sort_holters(move_holters.get_input_holters())
+    return jsonify({"plan": [assignment.as_dict() for assignment in move_holters.plan_distribution(holters)]})
+
+
+@app.route("/index/rebuild", methods=["POST"])
+@require_auth(is_admin=True)
+def index_rebuild():
+    count = index.rebuild()
+    return jsonify({"status": f"Index rebuilt, {count} holters ✅"})
+
+
+@app.route("/metrics")
+@require_auth(is_admin=True)
+def metrics_view():
+    import move_holters
+    waiting_holters, oldest_holter_age = move_holters.get_input_backlog()
+    if in_process_scheduler:
+        import holter
+        lines = metrics.render().splitlines()
+        pending_holters = move_holters.input_sources.get_stats()["pending"]
+        prefetch_stats = holter.get_prefetch_stats()
     else:
-        return jsonify({"status": "Job is not running ❌"})
+        # Passes are made by the distributor daemon, its metrics are taken from its status
+        status = move_holters.read_status() or {}
+        lines = metrics.render(exclude=metrics.DISTRIBUTOR_METRICS).splitlines()
+        lines += status.get("metrics", metrics.render(metrics.DISTRIBUTOR_METRICS)).splitlines()
+        pending_holters = ((status.get("last_pass") or {}).get("input") or {}).get("pending", 0)
+        prefetch_stats = status.get("prefetch") or {}
+    lines += metrics.render_gauge(
+        "telecardio_input_holters", "Holters waiting in the input folders.", waiting_holters
+    )
+    lines += metrics.render_gauge(
+        "telecardio_input_oldest_holter_age_seconds", "Age of the oldest holter in the input folders.",
+        oldest_holter_age or 0,
+    )
+    lines += metrics.render_gauge(
+        "telecardio_input_pending_holters", "Holters waiting until they stop changing.", pending_holters
+    )
+    lines += metrics.render_gauge(
+        "telecardio_header_prefetch_queue_depth", "Distributed holters waiting for header parsing.",
+        prefetch_stats.get("queue_depth", 0),
+    )
+    lines += metrics.render_gauge(
+        "telecardio_header_prefetch_last_lag_seconds", "Seconds from queueing to parsing of the last prefetched holter.",
+        prefetch_stats.get("last_lag") or 0,
+    )
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+_index_build_thread = None
+_index_build_lock = threading.Lock()
+
+
+def _build_index():
+    try:
+        index.get_built_at()
+    except Exception as e:
+        print(f"ERROR! Failed to build the index: {e}")
+
+
+@app.route("/ready")
+def ready():
+    """ Readiness probe: config is loaded and the index is built, 503 with the error otherwise.
+
+    Missing index is built in the background, the probe does not wait for the walk of the output tree.
+    """
+    global _index_build_thread
+    try:
+        config_version = config.version()
+        index_built_at = index.find_built_at()
+    except Exception as e:
+        return jsonify({"ready": False, "error": str(e)}), 503
+    if index_built_at is None:
+        with _index_build_lock:
+            if _index_build_thread is None or not _index_build_thread.is_alive():
+                _index_build_thread = threading.Thread(target=_build_index, name="index-build", daemon=True)
+                _index_build_thread.start()
+        return jsonify({"ready": False, "error": "index building"}), 503
+    return jsonify({
+        "ready": True,
+        "config_version": config_version,
+        "index_built_at": index_built_at,
+        "scheduler_running": _scheduler is not None and _scheduler.running,
+    })
 
 
 # ------ Error Handlers ------
@@ -484,5 +851,6 @@ def page_not_found(e):
 
 
 if __name__ == "__main__":
-    _start_scheduler()
+    # First pass waits a bit, so it does not compete with the first page loads after a restart
+    _start_scheduler(delay=config.get().get("startup_delay", 10))
     app.run(debug=True)  # PAVEL-TODO: remove debug=True for production